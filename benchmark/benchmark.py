@@ -0,0 +1,389 @@
+"""
+Offline benchmark of the run.py data path.
+
+Generates synthetic TIFF / OME-TIFF inputs over a matrix of axes orders and
+image sizes, then runs run.main() on them. Local stand-ins replace the
+BIAFLOWS job and the Cytomine client, and benchmark/fake_worker.py replaces
+micro-sam. Reports throughput (planes/s, MB/s) and peak memory per stage,
+taken from the run profile. Runs on a CPU-only machine without network
+access.
+
+Annotations go to a local stand-in of the Cytomine annotation endpoint;
+BENCHMARK_REQUEST_SECONDS adds a latency per upload request.
+
+    python benchmark/benchmark.py
+    python benchmark/benchmark.py --axes ZYX,TZCYX --sizes 1024,4096 --images 4
+    python benchmark/benchmark.py --param num_workers=2 --param scale_factor=0.5 --output results.csv
+
+Inputs are generated and every case is run in its own process, so the peak
+RSS of a case starts from a lean process and does not carry over the
+memory of the generated data or of earlier cases.
+"""
+import sys
+import os
+import csv
+import json
+import time
+import types
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import tifffile
+from scipy import ndimage
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+FAKE_WORKER_SCRIPT = os.path.join(BENCHMARK_DIR, "fake_worker.py")
+
+DEFAULT_AXES = "YX,ZYX,CZYX,TZCYX,YXS"
+# Job parameters that differ from the run.py defaults
+DEFAULT_PARAMETERS = {'model_type': 'vit_b_lm', 'segmentation_mode': 'ais', 'channel': -1}
+# Stages reported per case, in pipeline order
+REPORT_STAGES = ('open', 'read', 'blank_check', 'rescale', 'transport_write', 'prepare',
+                 'inference', 'wait_labels', 'assemble_labels', 'write', 'extract_polygons',
+                 'upload_annotations', 'upload_data')
+
+
+def synthetic_image(axes, size, sizes, seed=0):
+    """
+    Blobs on a noisy background with the given axes, e.g. 'TZCYX' or 'YXS'.
+
+    Y and X are `size`, the other axes come from `sizes`. A few base planes
+    are generated and shifted per plane, which keeps generation cheap and
+    gives every plane different content.
+    """
+    rng = np.random.RandomState(seed)
+    dtype = np.uint8 if 'S' in axes else np.uint16
+    high = 200 if dtype == np.uint8 else 4000
+
+    base = []
+    for _ in range(4):
+        plane = np.zeros((size, size), dtype=np.float32)
+        points = rng.randint(0, size, size=(max(4, size // 16), 2))
+        plane[points[:, 0], points[:, 1]] = 1.0
+        plane = ndimage.gaussian_filter(plane, sigma=max(1.0, size / 128))
+        base.append(plane / max(plane.max(), 1e-6))
+
+    # Generate planes in (other axes..., Y, X[, S]) order, then transpose to `axes`
+    canonical = [a for a in axes if a not in 'YXS'] + ['Y', 'X'] + (['S'] if 'S' in axes else [])
+    num_planes = int(np.prod([sizes[a] for a in canonical[:-3 if 'S' in axes else -2]], dtype=np.int64))
+    planes = np.empty((num_planes, size, size) + ((3,) if 'S' in axes else ()), dtype=dtype)
+    for k in range(num_planes):
+        plane = np.roll(base[k % len(base)], shift=(7 * k, 13 * k), axis=(0, 1)) * high
+        plane += rng.normal(high * 0.02, high * 0.01, size=plane.shape)
+        if 'S' in axes:
+            plane = plane[..., None] * np.array([1.0, 0.8, 0.6], dtype=np.float32)
+        planes[k] = np.clip(plane, 0, np.iinfo(dtype).max).astype(dtype)
+    planes = planes.reshape(tuple(size if a in 'YX' else sizes[a] for a in canonical))
+    return np.ascontiguousarray(np.transpose(planes, [canonical.index(a) for a in axes]))
+
+
+def write_input(path, data, axes, fmt):
+    """Write a plain (shaped) TIFF or an OME-TIFF carrying `axes`"""
+    photometric = 'rgb' if 'S' in axes else 'minisblack'
+    tifffile.imwrite(path, data, ome=fmt == 'ome', metadata={'axes': axes}, photometric=photometric)
+
+
+# --- Local stand-ins for the Cytomine client and the BIAFLOWS helpers ---
+
+class _Image:
+    def __init__(self, filename, image_id):
+        self.filename = filename
+        self.object = types.SimpleNamespace(id=image_id)
+
+
+class _Annotation:
+    def __init__(self, location=None, id_image=None, id_project=None, id_slice=None, **kwargs):
+        self.location = location
+        self.id_image = id_image
+        self.id_project = id_project
+        self.id_slice = id_slice
+
+
+class _AnnotationCollection(list):
+    """Records the annotations instead of posting them; each request of `chunk` takes BENCHMARK_REQUEST_SECONDS"""
+    posted = []
+
+    def save(self, chunk=15, n_workers=0):
+        seconds = float(os.environ.get("BENCHMARK_REQUEST_SECONDS", 0) or 0)
+        requests = -(-len(self) // chunk)
+        # Requests are sent by n_workers threads in parallel
+        time.sleep(seconds * -(-requests // max(1, n_workers)))
+        _AnnotationCollection.posted.extend(self)
+        return True
+
+
+class _SliceInstanceCollection(list):
+    def fetch_with_filter(self, key, value):
+        # The benchmark images are not on a server, their annotations carry no slice
+        return self
+
+
+class _JobStatus:
+    """Collects the status updates the workflow sends to Cytomine"""
+
+    def __init__(self):
+        self.updates = []
+
+    def update(self, **kwargs):
+        self.updates.append(kwargs)
+
+
+class LocalBiaflowsJob:
+    """BiaflowsJob stand-in holding the parameters and folders of one benchmark case"""
+    case = None
+
+    def __init__(self, parameters, folders):
+        self.parameters = types.SimpleNamespace(**parameters)
+        self.folders = folders
+        self.flags = {}
+        self.project = types.SimpleNamespace(id=1)
+        self.job = _JobStatus()
+
+    @classmethod
+    def from_cli(cls, argv):
+        return cls(cls.case['parameters'], cls.case['folders'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _prepare_data(problem_cls, bj, is_2d=None, **flags):
+    folders = bj.folders
+    in_imgs = [_Image(f, k + 1) for k, f in enumerate(sorted(os.listdir(folders['in'])))]
+    return in_imgs, [], folders['in'], None, folders['out'], folders['tmp']
+
+
+def _upload_data(problem_cls, bj, in_imgs, out_path, **kwargs):
+    """Reads every mask and locates its objects, in place of polygon extraction and upload"""
+    for img in in_imgs:
+        path = os.path.join(out_path, img.filename)
+        if os.path.exists(path):
+            labels = tifffile.imread(path)
+            ndimage.find_objects(labels.reshape((-1,) + labels.shape[-2:])[0])
+
+
+def install_standins():
+    """Register the stand-in cytomine / biaflows modules before run.py is imported"""
+    cytomine = types.ModuleType('cytomine')
+    models = types.ModuleType('cytomine.models')
+    models.Job = types.SimpleNamespace(RUNNING='RUNNING', TERMINATED='TERMINATED', FAILED='FAILED')
+    models.Annotation = _Annotation
+    models.AnnotationCollection = _AnnotationCollection
+    models.SliceInstanceCollection = _SliceInstanceCollection
+    cytomine.models = models
+    biaflows = types.ModuleType('biaflows')
+    biaflows.CLASS_OBJSEG = 'ObjSeg'
+    helpers = types.ModuleType('biaflows.helpers')
+    helpers.BiaflowsJob = LocalBiaflowsJob
+    helpers.prepare_data = _prepare_data
+    helpers.upload_data = _upload_data
+    helpers.upload_metrics = lambda *args, **kwargs: None
+    helpers.get_discipline = lambda bj, default: default
+    biaflows.helpers = helpers
+    sys.modules.update({'cytomine': cytomine, 'cytomine.models': models,
+                        'biaflows': biaflows, 'biaflows.helpers': helpers})
+
+
+def run_case(case):
+    """Run run.main() for one prepared case (in this process), returns the run profile"""
+    install_standins()
+    sys.path.insert(0, REPO_DIR)
+    import run
+    run.MICROSAM_WORKER_SCRIPT = FAKE_WORKER_SCRIPT
+    os.environ['MICROSAM_PYTHON'] = sys.executable
+    LocalBiaflowsJob.case = case
+    run.main([])
+    with open(os.path.join(case['folders']['out'], "microsam_profile.json")) as f:
+        profile = json.load(f)
+    profile['annotations'] = len(_AnnotationCollection.posted)
+    return profile
+
+
+def summarize(case, profile):
+    """Throughput and per-stage wall time / peak RSS of one case"""
+    stages = profile['stages']
+    planes = stages.get('read', {}).get('calls', 0)
+    megabytes = case['input_bytes'] / 1024 ** 2
+    wall = stages['pipeline']['wall_seconds']
+    inference = [r for r in profile['records'] if r['stage'] == 'inference' and r['peak_rss_mb'] is not None]
+    return {
+        'case': case['name'],
+        'images': case['images'],
+        'planes': planes,
+        'input_mb': round(megabytes, 2),
+        'pipeline_seconds': round(wall, 3),
+        'planes_per_second': round(planes / wall, 2) if wall > 0 else None,
+        'mb_per_second': round(megabytes / wall, 2) if wall > 0 else None,
+        'peak_rss_mb': profile['info']['peak_rss_mb'],
+        'worker_peak_rss_mb': max((r['peak_rss_mb'] for r in inference), default=None),
+        'annotations': profile.get('annotations'),
+        'stages': {stage: {'wall_seconds': round(stages[stage]['wall_seconds'], 4),
+                           'peak_rss_mb': stages[stage]['peak_rss_mb'],
+                           'rss_growth_mb': stages[stage].get('rss_growth_mb')}
+                   for stage in REPORT_STAGES if stage in stages},
+    }
+
+
+def prepare_case(root, axes, size, fmt, args):
+    """Folders and description of one case; the inputs are written by generate_inputs"""
+    name = f"{axes}_{size}_{fmt}"
+    folders = {k: os.path.join(root, name, k) for k in ('in', 'out', 'tmp')}
+    for path in folders.values():
+        os.makedirs(path)
+    parameters = dict(DEFAULT_PARAMETERS, **args.parameters)
+    return {'name': name, 'images': args.images, 'folders': folders, 'axes': axes, 'size': size,
+            'format': fmt, 'sizes': {'Z': args.z, 'C': args.c, 'T': args.t, 'S': 3},
+            'input_bytes': None, 'parameters': parameters}
+
+
+def generate_inputs(case):
+    """Write the synthetic inputs of a case, returns their size in bytes"""
+    input_bytes = 0
+    for k in range(case['images']):
+        data = synthetic_image(case['axes'], case['size'], case['sizes'], seed=k)
+        write_input(os.path.join(case['folders']['in'], f"image_{k}.tif"), data, case['axes'], case['format'])
+        input_bytes += data.nbytes
+    return input_bytes
+
+
+def parse_parameter(text):
+    key, _, value = text.partition('=')
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def print_report(results):
+    print()
+    print(f"{'case':<22}{'planes':>8}{'MB':>10}{'seconds':>10}{'planes/s':>10}{'MB/s':>10}{'peak MB':>10}"
+          f"{'worker MB':>11}{'annotations':>13}")
+    for r in results:
+        if 'error' in r:
+            print(f"{r['case']:<22}  FAILED: {r['error']}")
+            continue
+        print(f"{r['case']:<22}{r['planes']:>8}{r['input_mb']:>10.1f}{r['pipeline_seconds']:>10.2f}"
+              f"{r['planes_per_second'] or 0:>10.1f}{r['mb_per_second'] or 0:>10.1f}"
+              f"{r['peak_rss_mb'] or 0:>10.0f}{r['worker_peak_rss_mb'] or 0:>11.0f}{r['annotations'] or 0:>13}")
+    print()
+    print("Per stage: wall seconds (+MB the process peak RSS grew during the stage)")
+    for r in results:
+        if 'error' in r:
+            continue
+        stages = ", ".join(f"{stage} {s['wall_seconds']:.3f}s (+{s['rss_growth_mb'] or 0:.0f})"
+                           for stage, s in r['stages'].items())
+        print(f"  {r['case']}: {stages}")
+
+
+def save_results(path, results):
+    if path.endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+        return
+    fields = ['case', 'images', 'planes', 'input_mb', 'pipeline_seconds', 'planes_per_second',
+              'mb_per_second', 'peak_rss_mb', 'worker_peak_rss_mb', 'annotations']
+    stages = sorted({stage for r in results for stage in r.get('stages', {})}, key=REPORT_STAGES.index)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        # peak_rss_mb of a stage is the process peak so far, rss_growth_mb what the stage added to it
+        writer.writerow(fields + [f"{s}_seconds" for s in stages] + [f"{s}_peak_rss_mb" for s in stages]
+                        + [f"{s}_rss_growth_mb" for s in stages] + ['error'])
+        for r in results:
+            row = [r.get(k) for k in fields]
+            row += [r.get('stages', {}).get(s, {}).get('wall_seconds') for s in stages]
+            row += [r.get('stages', {}).get(s, {}).get('peak_rss_mb') for s in stages]
+            row += [r.get('stages', {}).get(s, {}).get('rss_growth_mb') for s in stages]
+            writer.writerow(row + [r.get('error')])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the micro-sam workflow data path")
+    parser.add_argument('--axes', default=DEFAULT_AXES, help="comma separated axes orders")
+    parser.add_argument('--sizes', default="256,1024", help="comma separated YX edge lengths")
+    parser.add_argument('--formats', default="tiff,ome", help="'tiff' (shaped TIFF) and/or 'ome' (OME-TIFF)")
+    parser.add_argument('--images', type=int, default=2, help="images per case")
+    parser.add_argument('--z', type=int, default=8, help="number of z-slices")
+    parser.add_argument('--c', type=int, default=2, help="number of channels")
+    parser.add_argument('--t', type=int, default=3, help="number of time points")
+    parser.add_argument('--param', action='append', default=[], metavar="KEY=VALUE",
+                        help="job parameter passed to run.py, e.g. num_workers=2 (values are parsed as JSON)")
+    parser.add_argument('--seconds_per_plane', type=float, default=0.0,
+                        help="simulated inference time per plane of the fake segmenter")
+    parser.add_argument('--request_seconds', type=float, default=0.0,
+                        help="simulated latency of one annotation upload request")
+    parser.add_argument('--output', default=None, help="write the results to a .csv or .json file")
+    parser.add_argument('--keep', action='store_true', help="keep the generated inputs and outputs")
+    parser.add_argument('--run_case', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--generate_case', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.generate_case:
+        # Child process: write the inputs of a case and record their size in the case file
+        with open(args.generate_case) as f:
+            case = json.load(f)
+        case['input_bytes'] = generate_inputs(case)
+        with open(args.generate_case, 'w') as f:
+            json.dump(case, f)
+        return 0
+
+    if args.run_case:
+        # Child process: run one prepared case and store its profile next to the case file
+        with open(args.run_case) as f:
+            case = json.load(f)
+        profile = run_case(case)
+        with open(args.run_case + ".profile.json", 'w') as f:
+            json.dump(profile, f)
+        return 0
+
+    args.parameters = dict(parse_parameter(p) for p in args.param)
+    env = dict(os.environ, BENCHMARK_SECONDS_PER_PLANE=str(args.seconds_per_plane),
+               BENCHMARK_REQUEST_SECONDS=str(args.request_seconds))
+    root = tempfile.mkdtemp(prefix="microsam_benchmark_")
+    results = []
+    try:
+        for axes in args.axes.split(','):
+            for size in (int(s) for s in args.sizes.split(',')):
+                for fmt in args.formats.split(','):
+                    case = prepare_case(root, axes, size, fmt, args)
+                    case_path = os.path.join(root, case['name'] + ".json")
+                    with open(case_path, 'w') as f:
+                        json.dump(case, f)
+                    # The data is generated in a separate process so this one stays small: a
+                    # child starts with the parent's RSS as its peak
+                    subprocess.run([sys.executable, os.path.abspath(__file__), '--generate_case', case_path],
+                                   check=True)
+                    with open(case_path) as f:
+                        case = json.load(f)
+                    print(f"Running {case['name']} ...", flush=True)
+                    start = time.time()
+                    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--run_case', case_path],
+                                          env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                    if proc.returncode != 0:
+                        log = proc.stdout.decode('utf-8', 'replace').strip().splitlines()
+                        results.append({'case': case['name'], 'error': log[-1] if log else f"exit {proc.returncode}"})
+                        continue
+                    with open(case_path + ".profile.json") as f:
+                        result = summarize(case, json.load(f))
+                    result['job_seconds'] = round(time.time() - start, 3)
+                    results.append(result)
+    finally:
+        if args.keep:
+            print(f"Inputs and outputs kept in {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print_report(results)
+    if args.output:
+        save_results(args.output, results)
+        print(f"Results written to {args.output}")
+    return 1 if any('error' in r for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,61 @@
+"""
+Stand-in for microsam_worker.py used by the benchmark harness.
+
+Speaks the same protocol as the real worker, but segments with a smoothed
+intensity threshold and connected components instead of SAM, so the data
+path of run.py can be measured on a CPU-only machine without micro-sam,
+torch or model downloads.
+
+BENCHMARK_SECONDS_PER_PLANE adds a fixed inference cost per plane and
+BENCHMARK_LOAD_SECONDS a model loading delay, to emulate a real model.
+"""
+import os
+import sys
+import time
+import numpy as np
+from scipy import ndimage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import microsam_worker
+
+
+class ThresholdSegmenter:
+    """Drop-in for MicroSamSegmenter: gaussian smoothing, mean + std threshold, labelling"""
+
+    def __init__(self, model_type, segmentation_mode, checkpoint=None, device=None, precision='fp32'):
+        self.model_type = model_type
+        self.segmentation_mode = segmentation_mode
+        # There is no encoder to quantize, every precision gives the fp32 result
+        self.precision = precision
+        self.seconds_per_plane = float(os.environ.get("BENCHMARK_SECONDS_PER_PLANE", 0) or 0)
+        self.load_seconds = float(os.environ.get("BENCHMARK_LOAD_SECONDS", 0) or 0)
+
+    def load(self):
+        time.sleep(self.load_seconds)
+
+    def _features(self, image, ndim, embedding_path):
+        """The smoothed image plays the role of the SAM embeddings, including the cache"""
+        features_path = os.path.join(embedding_path, "features.npy") if embedding_path else None
+        if features_path and os.path.exists(features_path):
+            return np.load(features_path)
+        # Volumes and time series are not smoothed across planes
+        sigma = (0,) * (image.ndim - 2) + (1, 1)
+        features = ndimage.gaussian_filter(np.asarray(image, dtype=np.float32), sigma)
+        if features_path:
+            os.makedirs(embedding_path, exist_ok=True)
+            np.save(features_path, features)
+        return features
+
+    def segment(self, image, ndim=2, tile_shape=None, halo=None, batch_size=1,
+                embedding_path=None, verbose=False, tracking=False):
+        image = np.asarray(image)
+        num_planes = image.shape[0] if image.ndim > 2 else 1
+        time.sleep(self.seconds_per_plane * num_planes)
+        features = self._features(image, ndim, embedding_path)
+        mask = features > features.mean() + features.std()
+        labels, _ = ndimage.label(mask)
+        return labels.astype(np.uint32)
+
+
+if __name__ == "__main__":
+    sys.exit(microsam_worker.main(sys.argv[1:], segmenter_cls=ThresholdSegmenter))
@@ -0,0 +1,176 @@
+"""
+Accuracy and speed of reduced precision inference against fp32.
+
+Segments the planes of a reference image set once with an fp32 worker and
+once with the requested precision, then reports per image and overall:
+- object F1 at IoU 0.5, with the fp32 objects as the reference
+- mean IoU of the matched objects
+- foreground Dice
+- seconds per plane of both runs and the speed-up
+
+    python benchmark/precision_delta.py --images /data/reference --model_type vit_b_lm --precision int8
+
+Runs next to run.py and starts the workers in the micro-sam environment the
+same way a job does (MICROSAM_PYTHON / MICROSAM_ENV_NAME).
+"""
+import sys
+import os
+import json
+import argparse
+import tempfile
+import shutil
+import itertools
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import run
+except ImportError:
+    # Outside the BIAFLOWS environment run.py only needs the stand-in modules
+    from benchmark import install_standins
+    install_standins()
+    import run
+
+
+def match_objects(reference, labels, threshold=0.5):
+    """
+    Match the objects of two label images by IoU.
+
+    Returns (matches, reference objects, predicted objects, IoUs of the
+    matches). Above an IoU of 0.5 every object has at most one match, so no
+    assignment problem has to be solved.
+    """
+    reference = np.asarray(reference, dtype=np.int64).ravel()
+    labels = np.asarray(labels, dtype=np.int64).ravel()
+    base = int(labels.max()) + 1
+    pairs, overlap = np.unique(reference * base + labels, return_counts=True)
+    ref_ids, pred_ids = pairs // base, pairs % base
+    touching = (ref_ids > 0) & (pred_ids > 0)
+    ref_ids, pred_ids, overlap = ref_ids[touching], pred_ids[touching], overlap[touching]
+    ref_area, pred_area = np.bincount(reference), np.bincount(labels)
+    iou = overlap / (ref_area[ref_ids] + pred_area[pred_ids] - overlap)
+    matched = iou > threshold
+    return (int(matched.sum()), int(np.count_nonzero(ref_area[1:])), int(np.count_nonzero(pred_area[1:])),
+            iou[matched])
+
+
+def compare(reference, labels):
+    """Object F1, mean matched IoU and foreground Dice of `labels` against `reference`"""
+    matches, num_reference, num_predicted, ious = match_objects(reference, labels)
+    foreground_ref, foreground_pred = reference > 0, labels > 0
+    denominator = foreground_ref.sum() + foreground_pred.sum()
+    return {
+        'objects_fp32': num_reference,
+        'objects': num_predicted,
+        'f1': 2 * matches / (num_reference + num_predicted) if num_reference + num_predicted else 1.0,
+        'mean_iou': float(ious.mean()) if len(ious) else None,
+        'dice': float(2 * np.logical_and(foreground_ref, foreground_pred).sum() / denominator) if denominator else 1.0,
+    }
+
+
+def load_planes(path, max_planes):
+    """Up to `max_planes` (t, z, c) planes of an image, in TZC order"""
+    with run.LazyTiffImage(path) as image:
+        shape = image.shape
+        indices = itertools.islice(itertools.product(range(shape[0]), range(shape[1]), range(shape[2])), max_planes)
+        return [image.plane(t, z, c) for t, z, c in indices]
+
+
+def segment_all(precision, images, args, tmp_path):
+    """Labels and seconds per plane of every reference image with one worker at `precision`"""
+    worker = run.MicroSamWorker(args.model_type, args.segmentation_mode, precision=precision,
+                                checkpoint=args.checkpoint)
+    worker.start()
+    options = {'ndim': 2, 'tile_shape': run.parse_shape(args.tile_shape), 'halo': run.parse_shape(args.halo),
+               'batch_size': args.batch_size, 'verbose': False}
+    results = {}
+    try:
+        for name, planes in images.items():
+            stack = run.MemmapSliceStack(tmp_path, f"{precision}_{len(results)}", len(planes),
+                                         planes[0].shape, planes[0].dtype)
+            stack.planes[:] = np.stack(planes)
+            items = [{'id': str(k), 'index': k} for k in range(len(planes))]
+            timings = {}
+            labels = worker.segment(items, options, stack=stack, timings=timings)
+            # Copy out of the memmap before the stack is removed
+            results[name] = ([np.array(labels[item['id']]) for item in items],
+                             sum(t['seconds'] for t in timings.values()) / len(items))
+            stack.close()
+    finally:
+        worker.close()
+    return results, worker.precision
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Accuracy delta of reduced precision micro-sam inference")
+    parser.add_argument('--images', required=True, help="folder with reference TIFF images")
+    parser.add_argument('--precision', default='int8', choices=('bf16', 'int8'))
+    parser.add_argument('--model_type', default='vit_b_lm')
+    parser.add_argument('--segmentation_mode', default='ais')
+    parser.add_argument('--checkpoint', default=None, help="local model weights for --model_type")
+    parser.add_argument('--tile_shape', default=None)
+    parser.add_argument('--halo', default=None)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--max_planes', type=int, default=8, help="planes per reference image")
+    parser.add_argument('--output', default=None, help="write the report to a .json file")
+    parser.add_argument('--worker_script', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.worker_script:
+        run.MICROSAM_WORKER_SCRIPT = os.path.abspath(args.worker_script)
+
+    names = sorted(f for f in os.listdir(args.images) if f.lower().endswith(('.tif', '.tiff')))
+    images = {name: load_planes(os.path.join(args.images, name), args.max_planes) for name in names}
+    print(f"Reference set: {len(images)} images, {sum(len(p) for p in images.values())} planes")
+
+    tmp_path = tempfile.mkdtemp(prefix="microsam_precision_")
+    try:
+        reference, _ = segment_all('fp32', images, args, tmp_path)
+        reduced, precision = segment_all(args.precision, images, args, tmp_path)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    if precision != args.precision:
+        print(f"Warning: the worker fell back to {precision}, the comparison is not meaningful")
+
+    report = {'model_type': args.model_type, 'segmentation_mode': args.segmentation_mode,
+              'precision': precision, 'images': {}}
+    print(f"\n{'image':<32}{'F1':>8}{'IoU':>8}{'Dice':>8}{'objects':>14}{'s/plane':>16}{'speed-up':>10}")
+    for name in names:
+        ref_labels, ref_seconds = reference[name]
+        labels, seconds = reduced[name]
+        planes = [compare(r, l) for r, l in zip(ref_labels, labels)]
+        ious = [p['mean_iou'] for p in planes if p['mean_iou'] is not None]
+        row = {
+            'planes': len(planes),
+            'f1': float(np.mean([p['f1'] for p in planes])),
+            'mean_iou': float(np.mean(ious)) if ious else None,
+            'dice': float(np.mean([p['dice'] for p in planes])),
+            'objects_fp32': sum(p['objects_fp32'] for p in planes),
+            'objects': sum(p['objects'] for p in planes),
+            'seconds_per_plane_fp32': ref_seconds,
+            'seconds_per_plane': seconds,
+            'speedup': ref_seconds / seconds if seconds > 0 else None,
+        }
+        report['images'][name] = row
+        print(f"{name:<32}{row['f1']:>8.3f}{row['mean_iou'] or 0:>8.3f}{row['dice']:>8.3f}"
+              f"{row['objects']:>7}/{row['objects_fp32']:<6}{seconds:>7.2f}/{ref_seconds:<8.2f}{row['speedup'] or 0:>9.2f}x")
+
+    rows = list(report['images'].values())
+    ious = [r['mean_iou'] for r in rows if r['mean_iou'] is not None]
+    report['overall'] = {
+        'f1': float(np.mean([r['f1'] for r in rows])) if rows else None,
+        'mean_iou': float(np.mean(ious)) if ious else None,
+        'dice': float(np.mean([r['dice'] for r in rows])) if rows else None,
+        'speedup': float(np.mean([r['speedup'] for r in rows if r['speedup']])) if rows else None,
+    }
+    overall = report['overall']
+    print(f"\n{precision} vs fp32: object F1 {overall['f1']:.3f}, matched IoU {overall['mean_iou'] or 0:.3f}, "
+          f"Dice {overall['dice']:.3f}, {overall['speedup'] or 0:.2f}x faster")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,321 @@
+"""
+Persistent micro-sam inference worker.
+
+run.py starts this script once per job with the python interpreter of the
+micro-sam conda environment. The SAM model and predictor are loaded once and
+kept in memory; slice batches are then received over stdin and the label
+arrays are sent back over stdout, or written in place when run.py shares
+memory-mapped .npy stacks with the worker.
+
+Every message is a single JSON header line, followed by the raw bytes (C order)
+of the arrays described in header["arrays"]. Only plain JSON and raw buffers
+cross the pipe, so the two sides may run different python/numpy versions.
+"""
+import sys
+import os
+import json
+import time
+import argparse
+import traceback
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def write_message(stream, header, arrays=()):
+    """Write a JSON header line followed by the raw bytes of `arrays`"""
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    header = dict(header)
+    header['arrays'] = [{'dtype': a.dtype.str, 'shape': list(a.shape)} for a in arrays]
+    stream.write(json.dumps(header).encode('utf-8') + b'\n')
+    for a in arrays:
+        stream.write(a.tobytes())
+    stream.flush()
+
+
+def _read_exact(stream, nbytes):
+    chunks = []
+    while nbytes > 0:
+        chunk = stream.read(nbytes)
+        if not chunk:
+            raise EOFError("Pipe closed while reading array data")
+        chunks.append(chunk)
+        nbytes -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_message(stream):
+    """Read one message written by `write_message`, returns (header, arrays)"""
+    line = stream.readline()
+    if not line:
+        raise EOFError("Pipe closed")
+    header = json.loads(line.decode('utf-8'))
+    arrays = []
+    for spec in header.get('arrays', []):
+        dtype = np.dtype(spec['dtype'])
+        shape = tuple(spec['shape'])
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        arrays.append(np.frombuffer(_read_exact(stream, nbytes), dtype=dtype).reshape(shape))
+    return header, arrays
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, None where it is not available"""
+    if resource is None:
+        return None
+    # ru_maxrss is reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _as_shape(value):
+    """JSON list -> tuple, None stays None"""
+    return tuple(int(v) for v in value) if value else None
+
+
+PRECISIONS = ('fp32', 'bf16', 'int8')
+
+
+def set_encoder_precision(predictor, precision):
+    """
+    Run the SAM image encoder of `predictor` at reduced precision, returns the precision in use.
+
+    'bf16' wraps the encoder in bfloat16 autocast, 'int8' replaces its linear
+    layers (attention and MLP, the bulk of the ViT compute) by dynamically
+    quantized ones. Dynamic quantization only runs on the CPU; on a GPU the
+    encoder stays in fp32. The mask decoder is left untouched.
+    """
+    import torch
+
+    if precision == 'fp32':
+        return precision
+    encoder = predictor.model.image_encoder
+    device_type = next(encoder.parameters()).device.type
+    if precision == 'int8':
+        if device_type != 'cpu':
+            print(f"int8 quantization is only supported on the CPU, keeping fp32 on {device_type}")
+            return 'fp32'
+        quantization = getattr(torch, 'ao', torch).quantization
+        quantization.quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        return precision
+    if precision == 'bf16':
+        forward = encoder.forward
+
+        def autocast_forward(*args, **kwargs):
+            with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+                # Embeddings go back to fp32 for the decoder and the embedding files
+                return forward(*args, **kwargs).float()
+        encoder.forward = autocast_forward
+        return precision
+    raise ValueError(f"Unknown precision '{precision}', expected one of {PRECISIONS}")
+
+
+class MicroSamSegmenter:
+    """Keeps the predictor loaded and builds segmenters on demand"""
+
+    def __init__(self, model_type, segmentation_mode, checkpoint=None, device=None, precision='fp32'):
+        self.model_type = model_type
+        self.segmentation_mode = segmentation_mode
+        self.checkpoint = checkpoint
+        self.device = device
+        self.precision = precision
+        self.predictor = None
+        self._segmenters = {}
+
+    def _get_segmenter(self, is_tiled):
+        import inspect
+        from micro_sam.automatic_segmentation import get_predictor_and_segmenter
+
+        if is_tiled in self._segmenters:
+            return self._segmenters[is_tiled]
+        if self.predictor is not None:
+            # The tiled and untiled segmenters share the loaded predictor, so the
+            # SAM weights are only held once
+            segmenter = self._segmenter_for(is_tiled)
+            self._segmenters[is_tiled] = segmenter
+            return segmenter
+
+        kwargs = {'model_type': self.model_type, 'checkpoint': self.checkpoint,
+                  'device': self.device, 'is_tiled': is_tiled}
+        # micro-sam >= 1.4 takes a segmentation_mode string, older releases an amg flag
+        if 'segmentation_mode' in inspect.signature(get_predictor_and_segmenter).parameters:
+            kwargs['segmentation_mode'] = self.segmentation_mode
+        else:
+            kwargs['amg'] = self.segmentation_mode == 'amg'
+        predictor, segmenter = get_predictor_and_segmenter(**kwargs)
+        self.precision = set_encoder_precision(predictor, self.precision)
+        self.predictor = predictor
+        self._segmenters[is_tiled] = segmenter
+        return segmenter
+
+    def _segmenter_for(self, is_tiled):
+        """Segmenter on the existing predictor, reusing the AIS decoder of the first segmenter"""
+        import inspect
+        from micro_sam import instance_segmentation
+
+        # get_amg in micro-sam < 1.4
+        factory = getattr(instance_segmentation, 'get_instance_segmentation_generator', None) or instance_segmentation.get_amg
+        decoder = getattr(next(iter(self._segmenters.values())), '_decoder', None)
+        kwargs = {'is_tiled': is_tiled}
+        if decoder is not None:
+            kwargs['decoder'] = decoder
+        elif 'segmentation_mode' in inspect.signature(factory).parameters:
+            kwargs['segmentation_mode'] = self.segmentation_mode
+        return factory(self.predictor, **kwargs)
+
+    def load(self):
+        """Load the model for the untiled case up front"""
+        self._get_segmenter(False)
+
+    def device_info(self):
+        """Device the model runs on and, for a GPU, its free memory in bytes after loading"""
+        try:
+            import torch
+            if self.device in (None, 'cuda') and torch.cuda.is_available():
+                free, _ = torch.cuda.mem_get_info()
+                return {'device': 'cuda', 'device_memory': int(free)}
+        except (ImportError, AttributeError, RuntimeError):
+            # Older torch without mem_get_info, or no usable CUDA runtime
+            pass
+        return {'device': self.device or 'cpu', 'device_memory': None}
+
+    def segment(self, image, ndim=2, tile_shape=None, halo=None, batch_size=1,
+                embedding_path=None, verbose=False, tracking=False):
+        from micro_sam import automatic_segmentation
+        from micro_sam.automatic_segmentation import automatic_instance_segmentation
+
+        segmenter = self._get_segmenter(tile_shape is not None)
+        if tracking and hasattr(automatic_segmentation, 'automatic_tracking'):
+            # The lineage is not exported, the labels are linked over time
+            labels, _ = automatic_segmentation.automatic_tracking(
+                predictor=self.predictor, segmenter=segmenter, input_path=image,
+                embedding_path=embedding_path, tile_shape=tile_shape, halo=halo,
+                verbose=verbose)
+            return np.asarray(labels, dtype=np.uint32)
+        if tracking:
+            # Older micro-sam releases: segment the time series as a volume
+            ndim = 3
+        labels = automatic_instance_segmentation(
+            predictor=self.predictor, segmenter=segmenter, input_path=image,
+            embedding_path=embedding_path, ndim=ndim, tile_shape=tile_shape,
+            halo=halo, verbose=verbose, batch_size=batch_size)
+        return np.asarray(labels, dtype=np.uint32)
+
+
+def _load_input(item, planes):
+    """One plane ('index'/'path') or a stack of planes ('indices'/'paths')"""
+    if 'indices' in item:
+        return np.asarray(planes[item['indices']])
+    if 'index' in item:
+        return np.asarray(planes[item['index']])
+    import tifffile
+    if 'paths' in item:
+        return np.stack([tifffile.imread(p) for p in item['paths']])
+    return tifffile.imread(item['path'])
+
+
+def handle_segment(segmenter, header, arrays):
+    """
+    Segment every item of a batch, returns (reply header, label arrays).
+
+    With an 'input_path'/'output_path' pair the planes are read from and the
+    labels written to the shared .npy memmaps, and no arrays are sent back.
+    """
+    options = header.get('options', {})
+    planes = np.load(header['input_path'], mmap_mode='r') if header.get('input_path') else None
+    out = np.load(header['output_path'], mmap_mode='r+') if header.get('output_path') else None
+    results, labels = [], []
+    for item in header['items']:
+        start, cpu_start = time.time(), time.process_time()
+        image = _load_input(item, planes)
+        seg = segmenter.segment(
+            image,
+            ndim=item.get('ndim', options.get('ndim', 2)),
+            tile_shape=_as_shape(options.get('tile_shape')),
+            halo=_as_shape(options.get('halo')),
+            batch_size=options.get('batch_size', 1),
+            embedding_path=item.get('embedding_path'),
+            verbose=options.get('verbose', False),
+            tracking=item.get('tracking', False))
+        if out is not None:
+            out[item['indices'] if 'indices' in item else item['index']] = seg
+        else:
+            labels.append(seg)
+        results.append({'id': item['id'], 'seconds': time.time() - start,
+                        'cpu_seconds': time.process_time() - cpu_start, 'peak_rss_mb': peak_rss_mb()})
+    if out is not None:
+        out.flush()
+    return {'status': 'ok', 'results': results}, labels
+
+
+def serve(segmenter, stdin, stdout):
+    """Request loop, runs until a shutdown message or EOF"""
+    while True:
+        try:
+            header, arrays = read_message(stdin)
+        except EOFError:
+            return
+        op = header.get('op')
+        if op == 'shutdown':
+            write_message(stdout, {'status': 'bye'})
+            return
+        try:
+            if op == 'segment':
+                reply, out_arrays = handle_segment(segmenter, header, arrays)
+            else:
+                raise ValueError(f"Unknown operation '{op}'")
+        except Exception as e:
+            traceback.print_exc()
+            reply, out_arrays = {'status': 'error', 'message': f"{type(e).__name__}: {e}"}, []
+        write_message(stdout, reply, out_arrays)
+
+
+def main(argv, segmenter_cls=None):
+    """Worker entry point; `segmenter_cls` replaces MicroSamSegmenter, e.g. for benchmarks"""
+    parser = argparse.ArgumentParser(description="Persistent micro-sam inference worker")
+    parser.add_argument('--model_type', required=True)
+    parser.add_argument('--mode', default='ais', help="'amg' or 'ais'")
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help="torch intra-op thread budget of this worker")
+    parser.add_argument('--precision', default='fp32', choices=PRECISIONS,
+                        help="image encoder precision")
+    args = parser.parse_args(argv)
+
+    if args.num_threads:
+        try:
+            import torch
+            torch.set_num_threads(args.num_threads)
+        except ImportError:
+            # Backends without torch (see benchmark/) only follow the OMP/MKL limits
+            pass
+
+    # The protocol owns the real stdout; anything micro-sam or torch prints goes to stderr
+    stdin = os.fdopen(os.dup(sys.stdin.fileno()), 'rb')
+    stdout = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    start = time.time()
+    segmenter = (segmenter_cls or MicroSamSegmenter)(args.model_type, args.mode, args.checkpoint, args.device,
+                                                     precision=args.precision)
+    try:
+        segmenter.load()
+    except Exception as e:
+        traceback.print_exc()
+        write_message(stdout, {'status': 'error', 'message': f"{type(e).__name__}: {e}"})
+        return 1
+    ready = {'status': 'ready', 'load_seconds': time.time() - start, 'pid': os.getpid(),
+             'peak_rss_mb': peak_rss_mb(), 'precision': getattr(segmenter, 'precision', 'fp32')}
+    if hasattr(segmenter, 'device_info'):
+        ready.update(segmenter.device_info())
+    write_message(stdout, ready)
+    serve(segmenter, stdin, stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -6,17 +6,37 @@ import subprocess
 import time
 import numpy as np
 import tifffile
-from tifffile import imwrite
-from skimage.transform import rescale
+from skimage.transform import resize
+from skimage import measure
+from scipy import ndimage
 import itertools
+import collections
+import re
+import hashlib
+import queue
+import threading
+import traceback
+import contextlib
+import functools
+import cProfile
+import pstats
+import io
+import csv
+import json
+import signal
+import tempfile
 
 # Cytomine / BIAFLOWS related imports
-from cytomine.models import Job
+from cytomine.models import Job, Annotation, AnnotationCollection
 from biaflows import CLASS_OBJSEG # Assuming Object Segmentation problem
 from biaflows.helpers import BiaflowsJob, prepare_data, upload_data, upload_metrics, get_discipline
 
+from microsam_worker import read_message, write_message, peak_rss_mb
+
 # Define the name of the Conda environment for micro-sam
-MICROSAM_ENV_NAME = "microsam_env"
+MICROSAM_ENV_NAME = os.environ.get("MICROSAM_ENV_NAME", "microsam_env")
+# Worker script started inside the micro-sam environment (lives next to run.py)
+MICROSAM_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "microsam_worker.py")
 
 def convert_to_5d_from_tifffile(volume, axes, target="XYZCT"):
     """
@@ -108,23 +128,2143 @@ def guess_axes(shape):
     else:
         return "".join(["Q"] * (ndim - 2)) + "YX"  # Unknown dims + YX
 
+class LazyTiffImage:
+    """
+    Plane-by-plane access to a TIFF file in TZCYX order.
+
+    The file is opened once and only the requested (t, z, c) planes are read:
+    through a memory map when the image data is stored uncompressed and
+    contiguous, otherwise one TIFF page at a time. Files whose layout fits
+    neither (e.g. tiled or unusual axes) are read in full as before.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tif = tifffile.TiffFile(path)
+        series = self.tif.series[0]
+        self.dtype = series.dtype
+        axes = getattr(series, 'axes', None)
+        self.axes = axes if axes else guess_axes(series.shape)
+        self._series = series
+        self._view = None
+        self._page = None
+        self.mode = None
+
+        self._view = self._memmap_view()
+        if self._view is not None:
+            self.mode = 'memmap'
+        else:
+            self._page = self._page_layout()
+            if self._page is not None:
+                self.mode = 'pages'
+            else:
+                # Fallback: read everything (same as tifffile.imread)
+                self._view = convert_to_5d_from_tifffile(series.asarray(), self.axes, target="TZCYX")[0]
+                self.mode = 'full'
+
+        if self._view is not None:
+            self.shape = self._view.shape
+        else:
+            self.shape = self._page['shape']
+
+    def _memmap_view(self):
+        series = self._series
+        offset = getattr(series, 'dataoffset', None)
+        if offset is None or len(series.shape) != len(self.axes):
+            return None
+        try:
+            dtype = np.dtype(self.tif.byteorder + series.dtype.char)
+            data = np.memmap(self.tif.filehandle.path, dtype=dtype, mode='r',
+                             offset=offset, shape=tuple(series.shape))
+        except (ValueError, OSError, AttributeError):
+            return None
+        return convert_to_5d_from_tifffile(data, self.axes, target="TZCYX")[0]
+
+    def _page_layout(self):
+        """Work out how (t, z, c) maps onto TIFF pages, None if it does not"""
+        series = self._series
+        axes = self.axes.upper().replace('S', 'C')
+        shape = tuple(series.shape)
+        if len(axes) != len(shape) or len(series.pages) == 0:
+            return None
+        page_ndim = len(series.pages[0].shape)
+        lead_axes, page_axes = axes[:-page_ndim], axes[-page_ndim:]
+        lead_shape = shape[:-page_ndim]
+        if any(a not in "TZC" for a in lead_axes) or set(page_axes) - set("CYX") or not {'Y', 'X'} <= set(page_axes):
+            return None
+        if len(series.pages) != int(np.prod(lead_shape, dtype=np.int64)) or len(set(axes)) != len(axes):
+            return None
+
+        sizes = dict(zip(axes, shape))
+        return {
+            'lead_axes': lead_axes,
+            'lead_shape': lead_shape,
+            'page_axes': page_axes,
+            'shape': (sizes.get('T', 1), sizes.get('Z', 1), sizes.get('C', 1), sizes['Y'], sizes['X'])
+        }
+
+    def plane(self, t, z, c):
+        """Read a single 2D (Y, X) plane"""
+        if self._view is not None:
+            return self._view[t, z, c, :, :]
+
+        layout = self._page
+        index = {'T': t, 'Z': z, 'C': c}
+        lead_index = tuple(index[a] for a in layout['lead_axes'])
+        key = int(np.ravel_multi_index(lead_index, layout['lead_shape'])) if lead_index else 0
+        page = self.tif.asarray(key=key, series=0)
+        page_axes = layout['page_axes']
+        if page.ndim != len(page_axes):
+            page = page.reshape([layout['shape']["TZCYX".index(a)] for a in page_axes])
+        if 'C' in page_axes:
+            page = np.take(page, c, axis=page_axes.index('C'))
+            page_axes = page_axes.replace('C', '')
+        return page if page_axes == "YX" else page.T
+
+    def close(self):
+        self._view = None
+        self.tif.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def parse_shape(value):
+    """Parse a shape string such as '[512,512]' or '512, 512' into a tuple of ints, None if empty"""
+    if value is None:
+        return None
+    numbers = re.findall(r"\d+", str(value))
+    return tuple(int(n) for n in numbers) if numbers else None
+
+def resolve_microsam_python():
+    """
+    Find the python interpreter of the micro-sam environment.
+
+    MICROSAM_PYTHON takes precedence, otherwise conda is asked once for the
+    interpreter of MICROSAM_ENV_NAME so the worker can be started without
+    paying the `conda run` overhead on every call.
+    """
+    python = os.environ.get("MICROSAM_PYTHON")
+    if python:
+        return python
+    result = subprocess.run(
+        ["conda", "run", "-n", MICROSAM_ENV_NAME, "python", "-c", "import sys; print(sys.executable)"],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True)
+    return result.stdout.strip().splitlines()[-1]
+
+@contextlib.contextmanager
+def job_scratch_dir():
+    """
+    Per-job folder for the shared slice stacks in MICROSAM_SCRATCH_DIR, or
+    /dev/shm (RAM backed) by default, removed when the job ends. Yields None
+    if neither is writable.
+
+    The folder is unique, so concurrent jobs on one host (Singularity shares
+    /dev/shm) never touch each other's stacks.
+    """
+    base = os.environ.get("MICROSAM_SCRATCH_DIR") or "/dev/shm"
+    if not (os.path.isdir(base) and os.access(base, os.W_OK)):
+        yield None
+        return
+    path = tempfile.mkdtemp(prefix="microsam_", dir=base)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def scratch_dir_for(nbytes, scratch, fallback, memory=None, reserved=0):
+    """
+    Pick the directory for the shared stacks of one image.
+
+    A folder set with MICROSAM_SCRATCH_DIR is always used. /dev/shm is only
+    used while these stacks and the `reserved` bytes of the stacks already
+    there fit in STACK_MEMORY_SHARE of the job's `memory` (RAM disk pages
+    count against the container's memory limit, see plan_image) and the RAM
+    disk has room; otherwise `fallback`, a folder in the job's tmp folder,
+    is used.
+    """
+    if scratch is None:
+        return fallback
+    if os.environ.get("MICROSAM_SCRATCH_DIR"):
+        return scratch
+    budget = (memory or 4 * 1024 ** 3) * STACK_MEMORY_SHARE
+    if reserved + nbytes <= budget and shutil.disk_usage(scratch).free > 1.25 * nbytes:
+        return scratch
+    return fallback
+
+class MemmapSliceStack:
+    """
+    Pair of memory-mapped .npy stacks shared with the micro-sam worker.
+
+    Planes are written straight into `planes`, the worker writes its labels
+    into `labels`; no TIFF encoding or decoding is involved.
+    """
+
+    @staticmethod
+    def nbytes(num_slices, plane_shape, dtype):
+        """Size of both stacks, planes plus uint32 labels"""
+        return num_slices * int(np.prod(plane_shape)) * (np.dtype(dtype).itemsize + 4)
+
+    def __init__(self, directory, name, num_slices, plane_shape, dtype):
+        self.input_path = os.path.join(directory, f"{name}_planes.npy")
+        self.output_path = os.path.join(directory, f"{name}_labels.npy")
+        shape = (num_slices,) + tuple(plane_shape)
+        self.planes = np.lib.format.open_memmap(self.input_path, mode='w+', dtype=dtype, shape=shape)
+        self.labels = np.lib.format.open_memmap(self.output_path, mode='w+', dtype=np.uint32, shape=shape)
+
+    def flush(self):
+        """Make the planes visible to the worker"""
+        self.planes.flush()
+
+    def close(self):
+        self.planes = None
+        self.labels = None
+        for path in (self.input_path, self.output_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed cache of SAM image embeddings shared across jobs.
+
+    Entries are micro-sam embedding folders named after a hash of the plane
+    content and of everything else that changes the embedding (model type,
+    tiling, scale factor). The least recently used entries are evicted once
+    the cache grows beyond `max_bytes`, down to LOW_WATER of it. The size is
+    tracked in memory; since other jobs may share the folder, it is
+    rescanned when the cache is opened, before evicting and every
+    `rescan_every` commits.
+    """
+
+    # Evictions free some room, so a full cache is not rescanned on every commit
+    LOW_WATER = 0.9
+
+    def __init__(self, root, max_bytes, rescan_every=64):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.rescan_every = rescan_every
+        self.tmp_root = os.path.join(root, "incomplete")
+        os.makedirs(self.tmp_root, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        # Looked up by the segmentation stage, committed by the write stage
+        self._lock = threading.RLock()
+        # path -> [last use, size in bytes]
+        self._entries = {}
+        self._total = 0
+        # Commits since the last scan
+        self._commits = 0
+        self._scan()
+        # A cache over a lowered limit shrinks even if this job only gets hits
+        if self._total > self.max_bytes:
+            self._drop_oldest()
+
+    def _scan(self):
+        """Refresh the entries from disk, including those stored, used or evicted by other jobs"""
+        entries = {}
+        for prefix in os.listdir(self.root):
+            prefix_path = os.path.join(self.root, prefix)
+            if prefix_path == self.tmp_root or not os.path.isdir(prefix_path):
+                continue
+            for name in os.listdir(prefix_path):
+                path = os.path.join(prefix_path, name)
+                try:
+                    last_use = os.path.getmtime(path)
+                except OSError:
+                    # Evicted by another job meanwhile
+                    continue
+                # Entries are never modified once committed, so known sizes stay valid
+                size = self._entries[path][1] if path in self._entries else self._size(path)
+                entries[path] = [last_use, size]
+        self._entries = entries
+        self._total = sum(size for _, size in entries.values())
+        self._commits = 0
+
+    @staticmethod
+    def _size(path):
+        total = 0
+        for dirpath, _, filenames in os.walk(path):
+            for f in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, f))
+                except OSError:
+                    pass
+        return total
+
+    @staticmethod
+    def key(plane, model_type, tile_shape=None, halo=None, scale_factor=1.0, precision='fp32'):
+        """Hash of the plane content and the parameters that affect its embedding"""
+        plane = np.ascontiguousarray(plane)
+        h = hashlib.sha256()
+        h.update(f"{plane.dtype.str}|{plane.shape}|{model_type}|{tile_shape}|{halo}|{float(scale_factor)}".encode('utf-8'))
+        if precision != 'fp32':
+            # Reduced precision embeddings never stand in for fp32 ones (or vice versa)
+            h.update(f"|{precision}".encode('utf-8'))
+        h.update(plane.data)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.zarr")
+
+    def lookup(self, key):
+        """
+        Returns (embedding_path, hit). On a miss the path is a private
+        location that `commit` moves into the cache once segmentation succeeded.
+        """
+        with self._lock:
+            path = self._path(key)
+            if os.path.isdir(path):
+                self.hits += 1
+                now = time.time()
+                os.utime(path, (now, now))
+                if path in self._entries:
+                    self._entries[path][0] = now
+                return path, True
+            self.misses += 1
+            return os.path.join(self.tmp_root, f"{key}.{os.getpid()}.{self.misses}.zarr"), False
+
+    def commit(self, key, tmp_path):
+        """Publish a freshly computed embedding and evict old entries if needed"""
+        with self._lock:
+            if not os.path.isdir(tmp_path):
+                return
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # Another job stored the same embedding in the meantime
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                return
+            size = self._size(path)
+            self._entries[path] = [time.time(), size]
+            self._total += size
+            self._commits += 1
+            self.evict()
+
+    def discard(self, tmp_path):
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def evict(self):
+        """Evict the least recently used entries if the cache is over its limit"""
+        with self._lock:
+            if self._total <= self.max_bytes and self._commits < self.rescan_every:
+                return
+            # Other jobs may have added, used or evicted entries meanwhile
+            self._scan()
+            if self._total > self.max_bytes:
+                self._drop_oldest()
+
+    def _drop_oldest(self):
+        target = self.max_bytes * self.LOW_WATER
+        for path, (_, size) in sorted(self._entries.items(), key=lambda e: e[1][0]):
+            shutil.rmtree(path, ignore_errors=True)
+            del self._entries[path]
+            self._total -= size
+            if self._total <= target:
+                break
+
+class JobManifest:
+    """
+    Durable record of the units a job has segmented, so a rerun can resume.
+
+    manifest.jsonl in `root` is an append-only journal. Its first line holds
+    the parameters that change the labels. Every further line records one
+    finished unit: the image, the (t, z, c) planes it covers, the tiling
+    it was segmented with and the .npy file under labels/ with its raw
+    labels. A journal written with other parameters is discarded, a unit
+    segmented with another tiling counts as missing. A line cut short by a
+    crash is ignored.
+
+    Images are identified by filename, size, a hash of the first and last
+    block of the file and either their Cytomine image id or, for local
+    inputs, their modification time. None of these needs more than two
+    reads, so resuming costs the same whatever the size of the images. A
+    re-downloaded copy of a Cytomine image is recognized; a corrected image
+    is uploaded as a new one and gets a new id.
+    """
+
+    # 3: image keys use the Cytomine id or mtime instead of hashing the whole file
+    VERSION = 3
+
+    def __init__(self, root, params):
+        self.root = root
+        self.labels_root = os.path.join(root, "labels")
+        self.journal_path = os.path.join(root, "manifest.jsonl")
+        self.params = params
+        self.params_key = hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+        # (image_key, unit_id) -> {'planes': [[t, z, c], ...], 'tiling': [tile_shape, halo],
+        #                          'path': relative .npy path}
+        self.units = {}
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._load()
+        self._journal = open(self.journal_path, 'a')
+        if os.path.getsize(self.journal_path) == 0:
+            self._append({'version': self.VERSION, 'params_key': self.params_key, 'params': params})
+        elif not self._ends_with_newline():
+            # Terminate a line cut short by a crash so the next entry starts on its own line
+            self._journal.write("\n")
+
+    def _load(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path) as f:
+            lines = f.read().splitlines()
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # Partially written line of a run that was killed
+                continue
+        if not entries or entries[0].get('params_key') != self.params_key or entries[0].get('version') != self.VERSION:
+            print(f"Checkpoint in {self.root} was made with other parameters, starting over")
+            os.remove(self.journal_path)
+            shutil.rmtree(self.labels_root, ignore_errors=True)
+            return
+        for entry in entries[1:]:
+            if 'unit' in entry:
+                self.units[(entry['image'], entry['unit'])] = {
+                    'planes': entry['planes'], 'tiling': entry.get('tiling'), 'path': entry['path']}
+
+    def _ends_with_newline(self):
+        with open(self.journal_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _append(self, entry):
+        self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    @staticmethod
+    def image_key(filename, path, image_id=None, block_size=1024 ** 2):
+        """Identity of an input image, without reading more than its first and last block"""
+        stat = os.stat(path)
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            # The TIFF header and the IFDs written at the end change with the image layout
+            h.update(f.read(block_size))
+            if stat.st_size > block_size:
+                f.seek(max(block_size, stat.st_size - block_size))
+                h.update(f.read(block_size))
+        # Downloads get a new mtime, the Cytomine id stays the same
+        origin = f"cytomine:{image_id}" if image_id is not None else f"mtime:{stat.st_mtime_ns}"
+        return f"{filename}|{stat.st_size}|{origin}|{h.hexdigest()[:32]}"
+
+    @staticmethod
+    def _tiling(tile_shape, halo):
+        """Tiling of a unit as stored in the journal"""
+        return [list(map(int, shape)) if shape is not None else None for shape in (tile_shape, halo)]
+
+    def lookup(self, image_key, unit_id, planes, tile_shape=None, halo=None):
+        """
+        Path of the stored labels of a unit covering exactly `planes` with the
+        given tiling, None if not done
+        """
+        with self._lock:
+            entry = self.units.get((image_key, unit_id))
+        if (entry is None or entry['planes'] != [list(p) for p in planes]
+                or entry['tiling'] != self._tiling(tile_shape, halo)):
+            return None
+        path = os.path.join(self.root, entry['path'])
+        return path if os.path.exists(path) else None
+
+    def record(self, image_key, unit_id, planes, labels, tile_shape=None, halo=None):
+        """Store the labels of a finished unit and add it to the journal"""
+        image_dir = hashlib.sha256(image_key.encode('utf-8')).hexdigest()[:16]
+        rel_path = os.path.join("labels", image_dir, f"{os.path.splitext(unit_id)[0]}.npy")
+        path = os.path.join(self.root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write aside and rename, so a recorded unit always has complete labels
+        with open(path + ".tmp", 'wb') as f:
+            np.save(f, labels)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        planes = [list(p) for p in planes]
+        tiling = self._tiling(tile_shape, halo)
+        with self._lock:
+            self._append({'image': image_key, 'unit': unit_id, 'planes': planes, 'tiling': tiling,
+                          'path': rel_path})
+            self.units[(image_key, unit_id)] = {'planes': planes, 'tiling': tiling, 'path': rel_path}
+
+    def close(self):
+        self._journal.close()
+
+class RunProfile:
+    """
+    Wall time, CPU time and peak RSS of the workflow stages, per image and per slice.
+
+    Repeated measurements of the same (stage, image, slice) are summed, so
+    per-plane work inside a loop ends up as a single row. CPU time is that of
+    the measuring thread, or of the worker process for 'inference'. The RSS
+    is the peak of the measured process so far; the RSS growth is how much
+    that peak rose while the stage ran, which attributes new memory highs to
+    stages (stages running concurrently or nested share the growth). Stages
+    may nest, e.g. 'write' includes the time spent waiting for labels.
+    """
+
+    FIELDS = ('stage', 'image', 'slice', 'calls', 'wall_seconds', 'cpu_seconds', 'peak_rss_mb',
+              'rss_growth_mb')
+
+    def __init__(self):
+        self.started = time.time()
+        self.info = {}
+        self._records = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, stage, image=None, slice_id=None, wall=0.0, cpu=None, rss=None, growth=None):
+        """Add one measurement to the (stage, image, slice_id) record"""
+        key = (stage, image, slice_id)
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                record = self._records[key] = {
+                    'stage': stage, 'image': image, 'slice': slice_id, 'calls': 0,
+                    'wall_seconds': 0.0, 'cpu_seconds': None, 'peak_rss_mb': None, 'rss_growth_mb': None}
+            record['calls'] += 1
+            record['wall_seconds'] += wall
+            if cpu is not None:
+                record['cpu_seconds'] = (record['cpu_seconds'] or 0.0) + cpu
+            if rss is not None:
+                record['peak_rss_mb'] = max(record['peak_rss_mb'] or 0.0, rss)
+            if growth is not None:
+                record['rss_growth_mb'] = (record['rss_growth_mb'] or 0.0) + growth
+
+    @contextlib.contextmanager
+    def stage(self, stage, image=None, slice_id=None):
+        """Measure the enclosed block"""
+        wall, cpu, rss = time.perf_counter(), time.thread_time(), peak_rss_mb()
+        try:
+            yield
+        finally:
+            peak = peak_rss_mb()
+            self.add(stage, image, slice_id, time.perf_counter() - wall, time.thread_time() - cpu, peak,
+                     peak - rss if peak is not None else None)
+
+    def records(self):
+        with self._lock:
+            return [dict(record) for record in self._records.values()]
+
+    def summary(self):
+        """Totals per stage, in the order the stages first ran"""
+        totals = collections.OrderedDict()
+        for record in self.records():
+            total = totals.setdefault(record['stage'], {
+                'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': None, 'peak_rss_mb': None, 'rss_growth_mb': None})
+            total['calls'] += record['calls']
+            total['wall_seconds'] += record['wall_seconds']
+            if record['cpu_seconds'] is not None:
+                total['cpu_seconds'] = (total['cpu_seconds'] or 0.0) + record['cpu_seconds']
+            if record['peak_rss_mb'] is not None:
+                total['peak_rss_mb'] = max(total['peak_rss_mb'] or 0.0, record['peak_rss_mb'])
+            if record['rss_growth_mb'] is not None:
+                total['rss_growth_mb'] = (total['rss_growth_mb'] or 0.0) + record['rss_growth_mb']
+        return totals
+
+    def save(self, directory, name="microsam_profile"):
+        """Write <name>.json (job info, stage totals and records) and <name>.csv (records)"""
+        records = self.records()
+        json_path = os.path.join(directory, f"{name}.json")
+        with open(json_path, 'w') as f:
+            json.dump({
+                'info': dict(self.info, started=self.started, wall_seconds=time.time() - self.started,
+                             peak_rss_mb=peak_rss_mb()),
+                'stages': self.summary(),
+                'records': records
+            }, f, indent=2)
+        csv_path = os.path.join(directory, f"{name}.csv")
+        with open(csv_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+        return json_path, csv_path
+
+class MicroSamWorkerError(RuntimeError):
+    """Raised when the micro-sam worker fails to start or to segment a batch"""
+
+    def __init__(self, message, results=None):
+        super().__init__(message)
+        # Labels of the slices that did succeed, if any
+        self.results = results or {}
+
+class MicroSamWorkerUnavailable(MicroSamWorkerError):
+    """Raised when a crashed micro-sam worker could not be restarted"""
+
+class MicroSamWorker:
+    """
+    Long-lived micro-sam process that keeps the model loaded for the whole job.
+
+    Batches of slices are sent over a pipe and the label arrays come back
+    over the same channel, see microsam_worker.py for the message format.
+    A worker that dies (e.g. killed for running out of memory) is started
+    again, up to `max_restarts` times in a row without a successful batch
+    in between, and the batch is retried once.
+    """
+
+    def __init__(self, model_type, segmentation_mode, python=None, num_threads=None, precision='fp32',
+                 max_restarts=3, checkpoint=None):
+        self.model_type = model_type
+        self.segmentation_mode = segmentation_mode
+        # Local model weights instead of the micro-sam model registry
+        self.checkpoint = checkpoint
+        self.python = python
+        self.num_threads = num_threads
+        self.precision = precision
+        self.process = None
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self.load_seconds = None
+        self.peak_rss_mb = None
+        # Reported by the worker once the model is loaded, free GPU memory for 'cuda'
+        self.device = None
+        self.device_memory = None
+
+    def start(self):
+        python = self.python or resolve_microsam_python()
+        cmd = [python, "-u", MICROSAM_WORKER_SCRIPT,
+               "--model_type", self.model_type,
+               "--mode", self.segmentation_mode]
+        if self.precision != 'fp32':
+            cmd.extend(["--precision", self.precision])
+        if self.checkpoint:
+            cmd.extend(["--checkpoint", self.checkpoint])
+        env = None
+        if self.num_threads:
+            # Cap the intra-op thread pools before torch is imported
+            cmd.extend(["--num_threads", str(self.num_threads)])
+            env = dict(os.environ)
+            for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+                env[var] = str(self.num_threads)
+        print(f"Starting micro-sam worker: {' '.join(cmd)}")
+        # stderr is inherited so micro-sam progress output ends up in the job log
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        header, _ = self._receive()
+        if header.get('status') != 'ready':
+            self.close()
+            raise MicroSamWorkerError(f"Micro-SAM worker failed to start: {header.get('message')}")
+        self.load_seconds = header.get('load_seconds')
+        self.peak_rss_mb = header.get('peak_rss_mb')
+        self.device = header.get('device')
+        self.device_memory = header.get('device_memory')
+        if header.get('precision', self.precision) != self.precision:
+            print(f"Micro-SAM worker runs the image encoder in {header.get('precision')} instead of {self.precision}")
+            self.precision = header.get('precision')
+        print(f"Micro-SAM worker {header.get('pid')} ready (model loaded in {self.load_seconds:.1f}s)")
+        return self
+
+    def _receive(self):
+        try:
+            return read_message(self.process.stdout)
+        except EOFError:
+            raise MicroSamWorkerError(f"Micro-SAM worker exited unexpectedly (code {self.process.poll()})")
+
+    def segment(self, items, options, stack=None, timings=None):
+        """
+        Segment a batch of slices.
+
+        Parameters
+        ----------
+        items : list of dict
+            One dict per slice with an 'id', either the input TIFF 'path' or the
+            'index' of the plane in `stack`, and optionally an 'embedding_path'.
+            Volumes and time series list their planes as 'paths' or 'indices'
+            instead and set 'ndim' to 3 ('tracking' for time series)
+        options : dict
+            ndim, tile_shape, halo, batch_size and verbose, shared by the whole batch
+        stack : MemmapSliceStack, optional
+            Shared scratch arrays; when given, labels are written in place
+            instead of being sent back over the pipe
+        timings : dict, optional
+            Filled with the worker's 'seconds', 'cpu_seconds' and
+            'peak_rss_mb' of each item, by item id
+
+        Returns
+        -------
+        labels : dict
+            Label array per item id
+
+        Raises
+        ------
+        MicroSamWorkerError
+            If the batch failed; MicroSamWorkerUnavailable if the worker died
+            and could not be restarted
+        """
+        for attempt in range(2):
+            if not self.running():
+                self._restart()
+            try:
+                labels = self._request(items, options, stack, timings)
+            except EOFError as e:
+                if attempt > 0:
+                    raise MicroSamWorkerError(f"{e}, also after a restart")
+                print(f"{e}, restarting it and retrying the batch")
+                continue
+            # Only crashes in a row count against max_restarts
+            self.restarts = 0
+            return labels
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def _restart(self):
+        """Replace a dead worker process by a new one with the model loaded"""
+        if self.restarts >= self.max_restarts:
+            raise MicroSamWorkerUnavailable(f"Micro-SAM worker keeps dying, giving up after {self.restarts} restarts")
+        self.restarts += 1
+        self.close()
+        try:
+            self.start()
+        except (MicroSamWorkerError, OSError) as e:
+            self.close()
+            raise MicroSamWorkerUnavailable(f"Micro-SAM worker could not be restarted: {e}")
+
+    def _request(self, items, options, stack, timings):
+        """Send one segment request; raises EOFError if the worker died meanwhile"""
+        request = {'op': 'segment', 'items': items, 'options': options}
+        if stack is not None:
+            stack.flush()
+            request['input_path'] = stack.input_path
+            request['output_path'] = stack.output_path
+        try:
+            write_message(self.process.stdin, request)
+            header, arrays = read_message(self.process.stdout)
+        except (EOFError, OSError):
+            # Make sure a half-dead process is gone before it is replaced
+            if self.process.poll() is None:
+                self.process.kill()
+            code = self.process.wait()
+            self.process = None
+            raise EOFError(f"Micro-SAM worker exited unexpectedly (code {code})")
+        if header.get('status') != 'ok':
+            raise MicroSamWorkerError(header.get('message', 'unknown error'))
+        if timings is not None:
+            timings.update((res['id'], res) for res in header['results'])
+        if stack is not None:
+            return {res['id']: stack.labels[item['indices'] if 'indices' in item else item['index']]
+                    for res, item in zip(header['results'], items)}
+        return {res['id']: labels for res, labels in zip(header['results'], arrays)}
+
+    def close(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            try:
+                write_message(self.process.stdin, {'op': 'shutdown'})
+                self.process.wait(timeout=30)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+def rescale_planes(planes, scale_factor):
+    """Rescale a (N, Y, X) stack of planes in one vectorized, anti-aliased bilinear pass"""
+    n, height, width = planes.shape
+    out_shape = (n, max(1, int(round(height * scale_factor))), max(1, int(round(width * scale_factor))))
+    # The plane axis keeps its size, so no smoothing happens across planes
+    return resize(planes, out_shape, order=1, preserve_range=True,
+                  anti_aliasing=scale_factor < 1.0).astype(planes.dtype)
+
+def upsample_labels(labels, shape, smooth=False):
+    """
+    Resample a label image to `shape` (Y, X) with nearest neighbour.
+
+    With `smooth`, every object is instead redrawn at the target resolution
+    from a bilinearly interpolated mask of the object, which smooths the
+    staircase outline nearest neighbour leaves behind. This is smoothing
+    only; the outlines are not fitted to the full-resolution image.
+    """
+    rows = np.minimum(((np.arange(shape[0]) + 0.5) * labels.shape[0] / shape[0]).astype(np.intp), labels.shape[0] - 1)
+    cols = np.minimum(((np.arange(shape[1]) + 0.5) * labels.shape[1] / shape[1]).astype(np.intp), labels.shape[1] - 1)
+    if not smooth:
+        return labels[rows[:, None], cols[None, :]]
+
+    scale_y, scale_x = shape[0] / labels.shape[0], shape[1] / labels.shape[1]
+    out = np.zeros(shape, dtype=labels.dtype)
+    for label_id, box in enumerate(ndimage.find_objects(labels), 1):
+        if box is None:
+            continue
+        # One pixel of margin so the interpolated outline is not clipped
+        y0, y1 = max(box[0].start - 1, 0), min(box[0].stop + 1, labels.shape[0])
+        x0, x1 = max(box[1].start - 1, 0), min(box[1].stop + 1, labels.shape[1])
+        oy0, oy1 = int(round(y0 * scale_y)), min(int(round(y1 * scale_y)), shape[0])
+        ox0, ox1 = int(round(x0 * scale_x)), min(int(round(x1 * scale_x)), shape[1])
+        if oy1 <= oy0 or ox1 <= ox0:
+            continue
+        mask = (labels[y0:y1, x0:x1] == label_id).astype(np.float32)
+        mask = resize(mask, (oy1 - oy0, ox1 - ox0), order=1, mode='edge', anti_aliasing=False) >= 0.5
+        out[oy0:oy1, ox0:ox1][mask] = label_id
+    return out
+
+def plane_contrast(plane, max_samples=256):
+    """
+    Cheap intensity-range statistic used to spot background planes.
+
+    Returns (p99 - p1) / (|p99| + |p1|) of a strided subsample of at most
+    about `max_samples` x `max_samples` pixels: 0 for a flat plane and close
+    to 1 for a plane with strong foreground against a dark background.
+    """
+    step = max(1, max(plane.shape) // max_samples)
+    sample = np.asarray(plane[::step, ::step], dtype=np.float32)
+    low, high = np.percentile(sample, (1, 99))
+    denominator = abs(high) + abs(low)
+    return float((high - low) / denominator) if denominator > 0 else 0.0
+
+def available_cores():
+    """Number of CPU cores this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+class SegmentationJob:
+    """
+    Handle for the slices of one image that were submitted to a MicroSamWorkerPool.
+
+    Labels become available chunk by chunk; `take` hands out a single slice
+    as soon as its chunk is done so results can be consumed while the rest
+    of the image is still being segmented. Labels that came back over the
+    pipe wait in .npy files in `spill_dir`, if given, rather than in memory,
+    so a lagging writer does not hold the labels of a whole image.
+    """
+
+    def __init__(self, chunks, spill_dir=None):
+        self.spill_dir = spill_dir
+        # Label array, or the path of its .npy file in spill_dir, per slice id
+        self.results = {}
+        # Worker timings per slice id, see MicroSamWorker.segment
+        self.timings = {}
+        self.errors = []
+        self._pending = {item['id'] for chunk in chunks for item in chunk}
+        self._remaining = len(chunks)
+        self._cond = threading.Condition()
+
+    def _finish_chunk(self, items, results=None, error=None, timings=None):
+        if results and self.spill_dir is not None:
+            results = {slice_id: self._spill(slice_id, labels) for slice_id, labels in results.items()}
+        with self._cond:
+            if results:
+                self.results.update(results)
+            if timings:
+                self.timings.update(timings)
+            if error is not None:
+                self.errors.append(error)
+            self._pending.difference_update(item['id'] for item in items)
+            self._remaining -= 1
+            self._cond.notify_all()
+
+    def _spill(self, slice_id, labels):
+        path = os.path.join(self.spill_dir, f"{os.path.splitext(slice_id)[0]}_labels.npy")
+        np.save(path, labels)
+        return path
+
+    @staticmethod
+    def _load(result):
+        """Labels of a result, read back (and removed) if they were spilled"""
+        if isinstance(result, str):
+            labels = np.load(result)
+            os.remove(result)
+            return labels
+        return result
+
+    def take(self, slice_id):
+        """Wait for the labels of one slice and remove them from the job, None if it failed"""
+        with self._cond:
+            while slice_id in self._pending:
+                self._cond.wait()
+            result = self.results.pop(slice_id, None)
+        return self._load(result)
+
+    def wait(self):
+        with self._cond:
+            while self._remaining > 0:
+                self._cond.wait()
+
+    def result(self):
+        """Wait for all chunks; raises MicroSamWorkerError (carrying the partial results) if any failed"""
+        self.wait()
+        with self._cond:
+            results, self.results = self.results, {}
+        results = {slice_id: self._load(result) for slice_id, result in results.items()}
+        if self.errors:
+            raise MicroSamWorkerError("; ".join(self.errors), results=results)
+        return results
+
+class MicroSamWorkerPool:
+    """
+    Several MicroSamWorker processes sharing the slices of the job.
+
+    Submitted slices are split into chunks that the workers pick up from a
+    shared queue, so the slices of one image are segmented concurrently and
+    the chunks of the next image can start as soon as a worker is free.
+    Each worker gets an equal share of the available cores as its torch
+    thread budget, so the workers do not oversubscribe the machine. A
+    worker that dies for good leaves the pool and its chunk goes back to
+    the queue for the others.
+    """
+
+    def __init__(self, model_type, segmentation_mode, num_workers=1, python=None, max_chunk_size=8,
+                 profile=None, precision='fp32'):
+        self.num_workers = max(1, int(num_workers))
+        self.profile = profile if profile is not None else RunProfile()
+        self.max_chunk_size = max(1, int(max_chunk_size))
+        threads = None
+        if self.num_workers > 1:
+            threads = max(1, available_cores() // self.num_workers)
+        self.workers = [MicroSamWorker(model_type, segmentation_mode, python=python, num_threads=threads,
+                                       precision=precision)
+                        for _ in range(self.num_workers)]
+        self._tasks = queue.Queue()
+        self._threads = []
+        # Set to the MicroSamWorkerUnavailable error once no worker can be restarted
+        self.failed = None
+        self._alive = list(self.workers)
+        self._lock = threading.Lock()
+
+    def start(self):
+        python = self.workers[0].python
+        if python is None:
+            with self.profile.stage('interpreter_lookup'):
+                python = resolve_microsam_python()
+        for worker in self.workers:
+            worker.python = python
+        # Model loading is the slow part of start-up, load in all workers at once
+        errors = []
+        def start_worker(k, worker):
+            try:
+                with self.profile.stage('worker_start', slice_id=f"worker_{k}"):
+                    worker.start()
+                self.profile.add('model_load', slice_id=f"worker_{k}", wall=worker.load_seconds,
+                                 rss=worker.peak_rss_mb)
+            except MicroSamWorkerError as e:
+                errors.append(e)
+        starters = [threading.Thread(target=start_worker, args=(k, w)) for k, w in enumerate(self.workers)]
+        for thread in starters:
+            thread.start()
+        for thread in starters:
+            thread.join()
+        if errors:
+            self.close()
+            raise errors[0]
+
+        for worker in self.workers:
+            thread = threading.Thread(target=self._dispatch, args=(worker,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.num_workers > 1:
+            print(f"Started {self.num_workers} micro-sam workers with {self.workers[0].num_threads} threads each")
+        return self
+
+    def _dispatch(self, worker):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            job, items, options, stack = task
+            try:
+                timings = {}
+                results = worker.segment(items, options, stack=stack, timings=timings)
+                job._finish_chunk(items, results=results, timings=timings)
+            except MicroSamWorkerUnavailable as e:
+                self._retire(worker, task, e)
+                return
+            except MicroSamWorkerError as e:
+                job._finish_chunk(items, error=str(e))
+            except Exception as e:
+                job._finish_chunk(items, error=f"{type(e).__name__}: {e}")
+
+    def _retire(self, worker, task, error):
+        """Take a worker that cannot be restarted out of the pool and hand its chunk to the others"""
+        with self._lock:
+            self._alive.remove(worker)
+            if self._alive:
+                print(f"{error}; continuing with {len(self._alive)} micro-sam workers")
+                self._tasks.put(task)
+                return
+            # No worker left, fail the chunk and everything still queued
+            self.failed = error
+            failed = [task]
+            while True:
+                try:
+                    queued = self._tasks.get_nowait()
+                except queue.Empty:
+                    break
+                if queued is not None:
+                    failed.append(queued)
+        for job, items, _, _ in failed:
+            job._finish_chunk(items, error=str(error))
+
+    def submit(self, items, options, stack=None, spill_dir=None):
+        """Queue slices for segmentation, returns a SegmentationJob (see there for `spill_dir`)"""
+        # Bounded chunks let results stream back while the image is still being processed
+        chunk_size = min(self.max_chunk_size, max(1, -(-len(items) // self.num_workers)))
+        chunks = [items[k:k + chunk_size] for k in range(0, len(items), chunk_size)]
+        job = SegmentationJob(chunks, spill_dir=spill_dir)
+        with self._lock:
+            if self.failed is not None:
+                raise MicroSamWorkerUnavailable(str(self.failed))
+            for chunk in chunks:
+                self._tasks.put((job, chunk, options, stack))
+        return job
+
+    def segment(self, items, options, stack=None):
+        """Segment slices and wait for the labels, see MicroSamWorker.segment"""
+        return self.submit(items, options, stack=stack).result()
+
+    def close(self):
+        for _ in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        for worker in self.workers:
+            worker.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+def available_memory():
+    """Memory in bytes this process may still allocate: MemAvailable, capped by a cgroup limit"""
+    available = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    # Containers see the host's meminfo, their own limit is in the cgroup (v2, then v1)
+    for limit_path, usage_path in (('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                                    '/sys/fs/cgroup/memory/memory.usage_in_bytes')):
+        try:
+            with open(limit_path) as f:
+                limit = f.read().strip()
+            with open(usage_path) as f:
+                usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        if limit.isdigit() and int(limit) < 1 << 60:
+            free = max(0, int(limit) - usage)
+            available = free if available is None else min(available, free)
+        break
+    return available
+
+# Rough memory use of the SAM image encoder per model size, in bytes: the weights
+# and the activations of one 1024 x 1024 forward pass (fp32)
+SAM_MODEL_MEMORY = {
+    'vit_t': (40 * 1024 ** 2, 512 * 1024 ** 2),
+    'vit_b': (375 * 1024 ** 2, 1536 * 1024 ** 2),
+    'vit_l': (1250 * 1024 ** 2, 3 * 1024 ** 3),
+    'vit_h': (2500 * 1024 ** 2, 4608 * 1024 ** 2),
+}
+# Input size of the SAM encoder; a tile plus its halo on both sides is resized to this
+SAM_INPUT_SIZE = 1024
+# Bytes per pixel of the full resolution decoder outputs and instance segmentation
+SEGMENTATION_BYTES_PER_PIXEL = 48
+# Shares of the host memory for the shared slice stacks in /dev/shm and for the
+# label planes waiting for annotation export
+STACK_MEMORY_SHARE = 0.15
+EXPORT_MEMORY_SHARE = 0.05
+
+def plan_workers(num_workers, model_type, cores=None, memory=None):
+    """
+    Number of worker processes to start: `num_workers`, capped at one per core
+    and at as many model copies (weights plus encoder activations) as fit in
+    the inference share of `memory`.
+    """
+    weights, activations = SAM_MODEL_MEMORY.get("_".join(str(model_type).split("_")[:2]), SAM_MODEL_MEMORY['vit_b'])
+    planned = max(1, int(num_workers))
+    if cores:
+        planned = min(planned, cores)
+    if memory:
+        planned = min(planned, max(1, int(memory * 0.7 // (weights + activations))))
+    return planned
+
+def plan_image(plane_shape, dtype, model_type, unit_planes=1, scale_factor=1.0, memory=None,
+               device_memory=None, num_workers=1, cores=None, overrides=None):
+    """
+    Choose tiling, halo, batch size and the number of planes held in memory for one image.
+
+    Parameters
+    ----------
+    plane_shape : tuple
+        (Y, X) of the input planes
+    dtype : numpy.dtype
+        Input pixel type
+    model_type : str
+        micro-sam model, e.g. 'vit_b_lm'; sized by its 'vit_*' prefix
+    unit_planes : int
+        Planes segmented together (z-slices of a volume, time points of a track)
+    scale_factor : float
+        Rescaling applied before segmentation
+    memory : int, optional
+        Host memory available to the job in bytes
+    device_memory : int, optional
+        Free GPU memory per worker in bytes, None when running on the CPU
+    num_workers : int
+        Worker processes sharing the host memory
+    cores : int, optional
+        CPU cores available to the job, shared by the workers
+    overrides : dict, optional
+        User supplied 'tile_shape', 'halo', 'batch_size' or 'plane_batch';
+        these are used as given (a tile_shape of None forces untiled prediction)
+
+    Returns
+    -------
+    dict
+        'tile_shape', 'halo', 'batch_size', 'plane_batch', plus 'user' (the
+        overridden keys) and 'estimates' (the figures the plan is based on)
+    """
+    overrides = overrides or {}
+    memory = memory or 4 * 1024 ** 3
+    weights, activations = SAM_MODEL_MEMORY.get("_".join(str(model_type).split("_")[:2]), SAM_MODEL_MEMORY['vit_b'])
+    height = max(1, int(round(plane_shape[0] * scale_factor)))
+    width = max(1, int(round(plane_shape[1] * scale_factor)))
+
+    # 30% of the host memory is left for loading planes (plane_batch, 10%), the
+    # shared slice stacks in /dev/shm (STACK_MEMORY_SHARE, see scratch_dir_for)
+    # and writing and exporting labels (EXPORT_MEMORY_SHARE); the rest is
+    # shared by the workers for inference
+    worker_memory = memory * 0.7 / max(1, num_workers)
+    segmentation_bytes = height * width * unit_planes * SEGMENTATION_BYTES_PER_PIXEL
+    model_memory = device_memory if device_memory else worker_memory - segmentation_bytes
+
+    # Tile planes much larger than the encoder input (small objects would be lost
+    # in the downscaling) and planes whose full-size segmentation does not fit
+    if 'tile_shape' in overrides:
+        tile_shape = overrides['tile_shape']
+    elif max(height, width) > 2 * SAM_INPUT_SIZE or segmentation_bytes + activations > worker_memory:
+        halo_size = SAM_INPUT_SIZE // 8
+        tile = SAM_INPUT_SIZE - 2 * halo_size
+        tile_shape = (min(tile, height), min(tile, width))
+    else:
+        tile_shape = None
+    if 'halo' in overrides:
+        halo = overrides['halo']
+    elif tile_shape is not None:
+        halo = tuple(max(16, min(SAM_INPUT_SIZE // 8, t // 4)) for t in tile_shape)
+    else:
+        halo = None
+
+    # Tiles are encoded in batches as far as the activations fit; on the CPU a batch
+    # larger than the worker's threads only costs memory
+    threads = max(1, cores // max(1, num_workers)) if cores else None
+    if 'batch_size' in overrides:
+        batch_size = overrides['batch_size']
+    elif tile_shape is not None:
+        num_tiles = -(-height // tile_shape[0]) * -(-width // tile_shape[1])
+        max_batch = 8 if device_memory else min(4, threads or 4)
+        batch_size = int(max(1, min(num_tiles, max_batch, model_memory // activations)))
+    else:
+        batch_size = 1
+
+    # Planes read and rescaled in one batch, within 10% of the host memory
+    plane_bytes = plane_shape[0] * plane_shape[1] * np.dtype(dtype).itemsize
+    if scale_factor != 1.0:
+        # The batched resize works on float64 copies
+        plane_bytes += plane_shape[0] * plane_shape[1] * 8 + height * width * 8
+    if 'plane_batch' in overrides:
+        plane_batch = overrides['plane_batch']
+    else:
+        plane_batch = int(max(1, min(64, memory * 0.1 // plane_bytes)))
+
+    if segmentation_bytes > worker_memory:
+        print(f"Warning: segmenting a {height}x{width}x{unit_planes} unit needs about "
+              f"{segmentation_bytes / 1024 ** 3:.1f} GB, more than the {worker_memory / 1024 ** 3:.1f} GB "
+              f"available per worker. Consider a scale_factor < 1 or fewer workers.")
+    return {
+        'tile_shape': tile_shape,
+        'halo': halo,
+        'batch_size': batch_size,
+        'plane_batch': plane_batch,
+        'user': sorted(overrides),
+        'estimates': {
+            'memory_gb': round(memory / 1024 ** 3, 2),
+            'cores': cores,
+            'threads_per_worker': threads,
+            'worker_memory_gb': round(worker_memory / 1024 ** 3, 2),
+            'device_memory_gb': round(device_memory / 1024 ** 3, 2) if device_memory else None,
+            'segmentation_gb': round(segmentation_bytes / 1024 ** 3, 3),
+            'encoder_activations_gb': round(activations / 1024 ** 3, 2)
+        }
+    }
+
+def select_indices(dims, time_series=-1, z_slices=-1, channel=0):
+    """Time points, z-slices and channels to process for an image with `dims`"""
+    # Time points
+    if time_series == -1:
+        time_points = list(range(dims['T']))
+    else:
+        time_points = [time_series] if time_series < dims['T'] else [0]
+        
+    # Z-slices
+    if z_slices == -1:
+        z_indices = list(range(dims['Z']))
+    else:
+        z_indices = [z_slices] if z_slices < dims['Z'] else [0]
+        
+    # Channels - handle similar to Cellpose
+    if channel == -1:
+        # Process all channels
+        channels = list(range(dims['C']))
+    elif isinstance(channel, (list, tuple)):
+        channels = list(channel)
+    else:
+        # Single channel specified (default is 0)
+        channels = [channel] if channel < dims['C'] else [0]
+        
+    # Handle case of no channels (shouldn't happen but defensive programming)
+    if len(channels) == 0:
+        channels = [0]
+    return time_points, z_indices, channels
+
+def _drop_collinear(contour):
+    """Remove the vertices inside straight runs of a contour, keeping its end points"""
+    steps = np.diff(contour, axis=0)
+    turn = steps[1:, 0] * steps[:-1, 1] - steps[1:, 1] * steps[:-1, 0]
+    return contour[np.concatenate(([True], turn != 0, [True]))]
+
+def label_polygons(labels, tolerance=0.5, exact_below=16):
+    """
+    Outlines of all objects of a label plane, as {label: [(N, 2) arrays of x, y]}.
+
+    A single find_objects pass locates every object; contours are then traced
+    on each object's bounding box only, instead of on a full-size mask per
+    object. Outlines follow the pixel edges (pixel (x, y) spans x..x+1,
+    y..y+1), like the polygons of the BIAFLOWS helpers. Holes are filled, so
+    only outer outlines are returned; an object with several parts gets one
+    ring per part. Rings are simplified with `tolerance` pixels (0 keeps
+    every vertex), except for objects smaller than `exact_below` pixels.
+    """
+    polygons = {}
+    for index, box in enumerate(ndimage.find_objects(labels)):
+        if box is None:
+            continue
+        label_id = index + 1
+        # One pixel of padding closes the contours of objects touching the box
+        mask = ndimage.binary_fill_holes(np.pad(labels[box] == label_id, 1))
+        simplify = tolerance and np.count_nonzero(mask) >= exact_below
+        # On the mask upsampled twice, marching squares puts the vertices on pixel edges
+        # or a quarter pixel from the corners, so rounding snaps them onto the corners
+        fine = mask.repeat(2, axis=0).repeat(2, axis=1)
+        rings = []
+        for contour in measure.find_contours(fine.astype(np.uint8), 0.5):
+            contour = np.round((contour + 0.5) / 2)
+            contour = contour[np.concatenate(([True], np.any(np.diff(contour, axis=0) != 0, axis=1)))]
+            # Straight runs are dropped first so the (pure Python) simplification only sees the corners
+            contour = _drop_collinear(contour)
+            if simplify:
+                simplified = measure.approximate_polygon(contour, tolerance)
+                if len(simplified) >= 4:
+                    contour = simplified
+            if len(contour) < 4:
+                continue
+            # (row, col) in the padded box -> (x, y) in the plane
+            rings.append(contour[:, ::-1] + (box[1].start - 1, box[0].start - 1))
+        if rings:
+            polygons[label_id] = rings
+    return polygons
+
+def polygon_wkt(rings, height):
+    """WKT of the rings of one object, in Cytomine coordinates (origin at the bottom left)"""
+    parts = ["((" + ", ".join(f"{x:.2f} {height - y:.2f}" for x, y in ring) + "))" for ring in rings]
+    if len(parts) == 1:
+        return "POLYGON " + parts[0]
+    return "MULTIPOLYGON (" + ", ".join(parts) + ")"
+
+class AnnotationExporter:
+    """
+    Turns label planes into Cytomine annotations and uploads them in batches.
+
+    The write stage hands over every label plane; polygons are extracted in
+    a background thread, so export and upload overlap with the segmentation
+    of the next images. Annotations of an image are only queued for upload
+    once its label image was written completely. They are posted as
+    AnnotationCollections of `batch_size`, split into requests of
+    `request_size` annotations sent by `num_uploaders` threads over the
+    client's pooled connection. Planes waiting for extraction are limited to
+    `max_queued_bytes`, beyond that the write stage waits (a single larger
+    plane is always accepted).
+    """
+
+    def __init__(self, project_id=None, batch_size=1000, request_size=200, num_uploaders=4,
+                 max_queued_bytes=256 * 1024 ** 2, upload=None, profile=None):
+        self.project_id = project_id
+        self.batch_size = max(1, int(batch_size))
+        self.request_size = max(1, int(request_size))
+        self.num_uploaders = max(0, int(num_uploaders))
+        self.upload = upload or self._upload_to_cytomine
+        self.profile = profile if profile is not None else RunProfile()
+        self.uploaded = 0
+        self.errors = []
+        self.max_queued_bytes = max_queued_bytes
+        self._queue = queue.Queue()
+        self._queued_bytes = 0
+        self._space = threading.Condition()
+        # image filename -> annotations waiting for the image to be complete
+        self._pending = {}
+        self._batch = []
+        self._slices = {}
+        # False once the server failed to list slices; annotations then go on the images
+        self._slices_supported = True
+        self._thread = None
+        self._cancelled = False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="microsam-export", daemon=True)
+        self._thread.start()
+        return self
+
+    def add_plane(self, bfimg, t, z, c, plane):
+        """Queue a label plane of an image; blocks while the exporter is far behind"""
+        with self._space:
+            while self._queued_bytes and self._queued_bytes + plane.nbytes > self.max_queued_bytes:
+                self._space.wait()
+            self._queued_bytes += plane.nbytes
+        self._queue.put(('plane', bfimg, (t, z, c), plane))
+
+    def finish_image(self, bfimg):
+        """The label image was written, its annotations may be uploaded"""
+        self._queue.put(('done', bfimg, None, None))
+
+    def discard_image(self, bfimg):
+        """Writing the label image failed, drop its annotations"""
+        self._queue.put(('drop', bfimg, None, None))
+
+    def close(self):
+        """Upload what is left and stop; raises RuntimeError if any upload failed"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self.errors:
+            raise RuntimeError(f"Annotation upload failed: {'; '.join(self.errors[:3])}")
+        return self.uploaded
+
+    def cancel(self):
+        """Stop without uploading the annotations that are still queued"""
+        self._cancelled = True
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            message = self._queue.get()
+            if message is None or self._cancelled:
+                break
+            kind, bfimg, plane_index, plane = message
+            try:
+                if kind == 'plane':
+                    self._extract(bfimg, plane_index, plane)
+                elif kind == 'done':
+                    self._batch.extend(self._pending.pop(bfimg.filename, []))
+                    if len(self._batch) >= self.batch_size:
+                        self._flush()
+                else:
+                    self._pending.pop(bfimg.filename, None)
+            except Exception as e:
+                traceback.print_exc()
+                self.errors.append(f"{bfimg.filename}: {type(e).__name__}: {e}")
+            finally:
+                if kind == 'plane':
+                    with self._space:
+                        self._queued_bytes -= plane.nbytes
+                        self._space.notify_all()
+        if self._cancelled:
+            return
+        try:
+            self._flush()
+        except Exception as e:
+            traceback.print_exc()
+            self.errors.append(f"{type(e).__name__}: {e}")
+
+    def _extract(self, bfimg, plane_index, plane):
+        with self.profile.stage('extract_polygons', bfimg.filename):
+            image_id = bfimg.object.id
+            slice_id = self._slice_id(bfimg, *plane_index)
+            annotations = self._pending.setdefault(bfimg.filename, [])
+            for rings in label_polygons(plane).values():
+                annotation = {'location': polygon_wkt(rings, plane.shape[0]), 'id_image': image_id}
+                if slice_id is not None:
+                    annotation['id_slice'] = slice_id
+                if self.project_id is not None:
+                    annotation['id_project'] = self.project_id
+                annotations.append(annotation)
+
+    def _slice_id(self, bfimg, t, z, c):
+        """Cytomine slice of plane (t, z, c), None for single-plane images or old servers"""
+        image_id = bfimg.object.id
+        if image_id not in self._slices:
+            self._slices[image_id] = self._fetch_slices(image_id) if self._slices_supported else {}
+        return self._slices[image_id].get((t, z, c))
+
+    def _fetch_slices(self, image_id):
+        """(t, z, c) -> slice id of an image; empty, and not asked again, if the server cannot list them"""
+        try:
+            from cytomine.models import SliceInstanceCollection
+            from requests.exceptions import RequestException
+        except ImportError:
+            # Client without slice support
+            self._slices_supported = False
+            return {}
+        try:
+            # The client returns False when the server answers with an HTTP error
+            slices = SliceInstanceCollection().fetch_with_filter("imageinstance", image_id)
+            error = None if slices is not False else "HTTP error"
+        except (RequestException, ValueError) as e:
+            slices, error = False, f"{type(e).__name__}: {e}"
+        if error is not None:
+            print(f"Warning: could not fetch the slices of image {image_id} ({error}), "
+                  f"annotations are attached to their images instead")
+            self._slices_supported = False
+            return {}
+        return {(s.time, s.zStack, s.channel): s.id for s in slices}
+
+    def _flush(self):
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        with self.profile.stage('upload_annotations'):
+            self.upload(batch)
+        self.uploaded += len(batch)
+        print(f"Uploaded {len(batch)} annotations ({self.uploaded} in total)")
+
+    def _upload_to_cytomine(self, annotations):
+        collection = AnnotationCollection()
+        for annotation in annotations:
+            collection.append(Annotation(**annotation))
+        collection.save(chunk=self.request_size, n_workers=self.num_uploaders)
+
+def _image_stage(method):
+    """
+    Record an ImageProcessor stage in the run profile, and run it under
+    cProfile for the image selected with the 'profile_image' parameter.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        # prepare(i, bfimg), segment(task) and write(task)
+        bfimg = args[1] if len(args) > 1 else args[0]['bfimg']
+        profiler = None
+        if self.params.get('profile_image') == bfimg.filename:
+            # cProfile only sees the calling thread, every stage gets its own profiler
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            with self.profile.stage(method.__name__, bfimg.filename):
+                return method(self, *args)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                with self._stats_lock:
+                    self.cprofiles.append(profiler)
+    return wrapper
+
+class ImageProcessor:
+    """
+    The three per-image stages of the workflow.
+
+    `prepare` opens an image and hands its selected planes to the transport,
+    `segment` submits them to the micro-sam worker pool and `write` waits
+    for the labels, then assembles and saves the label image. Each stage
+    takes and returns the task dict of one image; a failure is recorded in
+    task['error'] so later stages only clean up.
+    """
+
+    def __init__(self, bj, pool, in_path, out_path, tmp_path, total_images, params,
+                 embedding_cache=None, profile=None, manifest=None, exporter=None):
+        self.bj = bj
+        self.pool = pool
+        self.in_path = in_path
+        self.out_path = out_path
+        self.tmp_path = tmp_path
+        self.total_images = total_images
+        self.params = params
+        self.embedding_cache = embedding_cache
+        self.profile = profile if profile is not None else RunProfile()
+        # Finished units of earlier runs are loaded instead of segmented again
+        self.manifest = manifest
+        # Builds and uploads the annotations from the label planes as they are written
+        self.exporter = exporter
+        # cProfile.Profile objects of the stages of the 'profile_image'
+        self.cprofiles = []
+        # Stages run in different threads, keep job status updates serialized
+        self._status_lock = threading.Lock()
+        self.stats = {'planes': 0, 'skipped_planes': 0, 'segmented_planes': 0, 'resumed_planes': 0,
+                      'segment_seconds': 0.0}
+        self._stats_lock = threading.Lock()
+        # Bytes of the shared stacks currently in the scratch folder, see scratch_dir_for
+        self._scratch_reserved = 0
+        self._scratch_lock = threading.Lock()
+
+    def _count(self, **increments):
+        with self._stats_lock:
+            for key, value in increments.items():
+                self.stats[key] += value
+
+    def update(self, progress, comment):
+        with self._status_lock:
+            self.bj.job.update(progress=progress, statusComment=comment)
+
+    def _fail(self, task, e):
+        error_message = f"Error processing {task['bfimg'].filename}: {str(e)}"
+        print(error_message)
+        traceback.print_exc()
+        task['error'] = error_message
+        return task
+
+    @_image_stage
+    def prepare(self, i, bfimg):
+        """Open the image, select the planes to process and write them to the transport"""
+        params = self.params
+        progress = 5 + int(60 * (i / self.total_images))
+        self.update(progress, f"Processing image {i+1}/{self.total_images}: {bfimg.filename}")
+        
+        # Create unique temporary directories for this specific image
+        img_tmp_path = os.path.join(self.tmp_path, f"img_{i}")
+        task = {
+            'i': i,
+            'bfimg': bfimg,
+            'progress': progress,
+            'img_tmp_path': img_tmp_path,
+            'img_ms_prep_path': os.path.join(img_tmp_path, "ms_prep"),
+            'img_ms_emb_path': os.path.join(img_tmp_path, "ms_embeddings"),
+            # Lazily opened input and in-memory handoff to the worker (memmap transport only)
+            'image': None,
+            'stack': None,
+            'slice_info': [],
+            # Identity of the input in the checkpoint manifest
+            'image_key': None,
+            'error': None
+        }
+        
+        # Create directories for this image
+        for path in [img_tmp_path, task['img_ms_prep_path'], task['img_ms_emb_path']]:
+            os.makedirs(path, exist_ok=True)
+        
+        try:
+            # Open the input image lazily; planes are only read when they are needed
+            with self.profile.stage('open', bfimg.filename):
+                image = task['image'] = LazyTiffImage(os.path.join(self.in_path, bfimg.filename))
+            if self.manifest is not None:
+                with self.profile.stage('image_key', bfimg.filename):
+                    task['image_key'] = JobManifest.image_key(
+                        bfimg.filename, os.path.join(self.in_path, bfimg.filename),
+                        image_id=getattr(getattr(bfimg, 'object', None), 'id', None))
+            axes = image.axes
+                    
+            # Planes are addressed in standardized 5D format (TZCYX)
+            self.update(progress, f"Processing image with original axes: {axes}")
+            print(f"Reading {bfimg.filename} plane by plane ({image.mode})")
+            
+            # Get image dimensions
+            dims = task['dims'] = {
+                'T': image.shape[0],  # Time
+                'Z': image.shape[1],  # Depth/slices
+                'C': image.shape[2],  # Channels
+                'Y': image.shape[3],  # Height
+                'X': image.shape[4]   # Width
+            }
+            self.update(progress, f"Dimensions (TZCYX): {dims}")
+            # Determine which slices to process based on parameters
+            time_points, z_indices, channels = select_indices(
+                dims, params['time_series'], params['z_slices'], params['channel'])
+            task.update(time_points=time_points, z_indices=z_indices, channels=channels)
+            
+            # Log which dimensions are being processed
+            total_slices_to_process = len(time_points) * len(z_indices) * len(channels)
+            self.update(progress, f"Processing {len(time_points)} time points, {len(z_indices)} z-slices, {len(channels)} channels ({total_slices_to_process} total slices)")
+            print(f"Time points: {time_points}")
+            print(f"Z-slices: {z_indices}")
+            print(f"Channels: {channels}")
+            if len(channels) == 1 and dims['C'] > 1:
+                print(f"Note: Only processing channel {channels[0]} out of {dims['C']} available channels. Set channel=-1 to process all channels.")
+            
+            # Create mapping from original indices to output array indices
+            task['index_mapping'] = {
+                'T': {t: idx for idx, t in enumerate(time_points)},
+                'Z': {z: idx for idx, z in enumerate(z_indices)},
+                'C': {c: idx for idx, c in enumerate(channels)}
+            }
+            
+            # Tiling, batch size and planes held in memory for this image
+            plan = self._plan(task, image.dtype)
+            
+            blank_threshold = params.get('blank_threshold', 0) or 0
+            slice_info = task['slice_info']
+            
+            # First, create all the 2D slices needed and track their info
+            batch = []
+            for index, (t, z, c) in enumerate(itertools.product(time_points, z_indices, channels)):
+                slice_dict = {
+                    'cache_key': None,
+                    # Create a simple unique filename for this slice
+                    'filename': f"slice_t{t}_z{z}_c{c}.tif",
+                    't': t,
+                    'z': z,
+                    'c': c,
+                    'index': index,
+                    'path': None,
+                    'blank': False,
+                    # Labels stored by an earlier run of the same job
+                    'checkpoint': self._checkpoint(task, t, z, c)
+                }
+                slice_info.append(slice_dict)
+                if slice_dict['checkpoint'] is not None:
+                    continue
+                
+                # Read only this 2D slice from disk
+                with self.profile.stage('read', bfimg.filename, f"slice_t{t}_z{z}_c{c}"):
+                    slice_2d = image.plane(t, z, c)
+                
+                # Background planes never reach the model, they get an empty label plane
+                if blank_threshold > 0 and self._is_blank(bfimg.filename, slice_2d, blank_threshold):
+                    slice_dict['blank'] = True
+                    # Volumes and tracks are only skipped as a whole, see _group_units
+                    if params['dimension_mode'] == '2d':
+                        continue
+                
+                # Planes are rescaled and handed to the transport in batches
+                batch.append((slice_dict, slice_2d))
+                if len(batch) >= plan['plane_batch']:
+                    self._store_batch(task, batch, total_slices_to_process)
+                    batch = []
+            self._store_batch(task, batch, total_slices_to_process)
+            task['units'] = self._group_units(slice_info, params['dimension_mode'])
+            # Track number of slices created
+            num_blank = sum(1 for info in slice_info if info['blank'])
+            num_resumed = sum(1 for info in slice_info if info['checkpoint'] is not None)
+            self._count(planes=len(slice_info), skipped_planes=num_blank, resumed_planes=num_resumed)
+            if num_resumed:
+                print(f"Resuming {bfimg.filename}: {num_resumed}/{len(slice_info)} slices were segmented by an earlier run")
+            print(f"Created {len(slice_info) - num_blank - num_resumed} slices for processing")
+            if params['dimension_mode'] != '2d':
+                print(f"Grouped into {len(task['units'])} {'volumes' if params['dimension_mode'] == 'volume' else 'time series'}")
+            if num_blank:
+                print(f"Skipped {num_blank} blank planes (contrast below {blank_threshold})")
+            # Debug: Print all created filenames
+            print("Created slice filenames:")
+            for info in slice_info:
+                if not info['blank'] and info['checkpoint'] is None:
+                    print(f"  - {info['filename']}")
+        except Exception as e:
+            self._fail(task, e)
+        return task
+
+    def _plan(self, task, dtype):
+        """Resource plan of an image, see plan_image; user settings override the planner"""
+        params, dims = self.params, task['dims']
+        if params.get('auto_plan', True):
+            unit_planes = {'volume': len(task['z_indices']), 'tracking': len(task['time_points'])}.get(
+                params['dimension_mode'], 1)
+            worker = self.pool.workers[0] if self.pool is not None else None
+            plan = plan_image((dims['Y'], dims['X']), dtype, params['model_type'], unit_planes=unit_planes,
+                              scale_factor=params['scale_factor'], memory=params.get('memory'),
+                              device_memory=getattr(worker, 'device_memory', None),
+                              num_workers=getattr(self.pool, 'num_workers', 1), cores=available_cores(),
+                              overrides=params.get('plan_overrides'))
+        else:
+            # Static settings as given in the job parameters
+            options = params['segment_options']
+            plan = {'tile_shape': options['tile_shape'], 'halo': options['halo'],
+                    'batch_size': options['batch_size'] or 1, 'plane_batch': params.get('plane_batch', 16),
+                    'user': []}
+        task['plan'] = plan
+        task['segment_options'] = dict(params['segment_options'], tile_shape=plan['tile_shape'],
+                                       halo=plan['halo'], batch_size=plan['batch_size'])
+        user = plan.get('user') or []
+        described = ", ".join(f"{key} {plan[key]}{' (user)' if key in user else ''}"
+                              for key in ('tile_shape', 'halo', 'batch_size', 'plane_batch'))
+        budget = plan.get('estimates', {}).get('worker_memory_gb')
+        self.update(task['progress'], f"Plan for {task['bfimg'].filename}: {described}"
+                                      + (f" ({budget} GB per worker)" if budget is not None else ""))
+        self.profile.info.setdefault('plans', {})[task['bfimg'].filename] = plan
+        return plan
+
+    def _is_blank(self, image_name, plane, blank_threshold):
+        with self.profile.stage('blank_check', image_name):
+            return plane_contrast(plane) < blank_threshold
+
+    @staticmethod
+    def _unit_id(t, z, c, dimension_mode):
+        """Id of the unit the plane (t, z, c) is segmented in"""
+        if dimension_mode == 'volume':
+            return f"volume_t{t}_c{c}"
+        if dimension_mode == 'tracking':
+            return f"track_z{z}_c{c}"
+        return f"slice_t{t}_z{z}_c{c}.tif"
+
+    def _unit_planes(self, task, t, z, c):
+        """All (t, z, c) planes of the unit of plane (t, z, c), in unit order"""
+        dimension_mode = self.params['dimension_mode']
+        if dimension_mode == 'volume':
+            return [(t, zz, c) for zz in task['z_indices']]
+        if dimension_mode == 'tracking':
+            return [(tt, z, c) for tt in task['time_points']]
+        return [(t, z, c)]
+
+    def _checkpoint(self, task, t, z, c):
+        """
+        Stored labels of the unit of plane (t, z, c) from an earlier run, None if
+        missing or segmented with another tiling than planned for this run
+        """
+        if self.manifest is None:
+            return None
+        plan = task['plan']
+        return self.manifest.lookup(task['image_key'], self._unit_id(t, z, c, self.params['dimension_mode']),
+                                    self._unit_planes(task, t, z, c), plan['tile_shape'], plan['halo'])
+
+    @staticmethod
+    def _group_units(slice_info, dimension_mode):
+        """
+        Group slices into the units that are segmented in one go.
+
+        '2d' segments every plane on its own, 'volume' each (t, c) z-stack
+        and 'tracking' each (z, c) time series. Slices are generated in TZC
+        order, so planes within a unit are ordered by z or t respectively.
+        A volume or track is only skipped when all of its planes are blank.
+        """
+        units = collections.OrderedDict()
+        for slice_dict in slice_info:
+            unit_id = ImageProcessor._unit_id(slice_dict['t'], slice_dict['z'], slice_dict['c'], dimension_mode)
+            planes = units.setdefault(unit_id, [])
+            slice_dict['unit'] = unit_id
+            slice_dict['unit_pos'] = len(planes) if dimension_mode != '2d' else None
+            planes.append(slice_dict)
+        if dimension_mode != '2d':
+            for planes in units.values():
+                blank = all(s['blank'] for s in planes)
+                for slice_dict in planes:
+                    slice_dict['blank'] = blank
+        return units
+
+    def _store_batch(self, task, batch, num_slices):
+        """Rescale a batch of (slice_dict, plane) pairs in one pass and write them to the transport"""
+        if not batch:
+            return
+        params = self.params
+        scale_factor = params['scale_factor']
+        planes = [plane for _, plane in batch]
+        image_name = task['bfimg'].filename
+        
+        # Apply scaling if needed
+        if scale_factor != 1.0:
+            with self.profile.stage('rescale', image_name):
+                planes = rescale_planes(np.stack(planes), scale_factor)
+        
+        for (slice_dict, _), slice_2d in zip(batch, planes):
+            self._store_plane(task, slice_dict, slice_2d, num_slices)
+
+    def _store_plane(self, task, slice_dict, slice_2d, num_slices):
+        """Hand one (rescaled) plane to the transport and compute its cache key"""
+        params = self.params
+        image_name = task['bfimg'].filename
+        with self.profile.stage('transport_write', image_name):
+            if params['transport'] == 'memmap':
+                # Write the plane straight into the shared stack
+                if task['stack'] is None:
+                    nbytes = MemmapSliceStack.nbytes(num_slices, slice_2d.shape, slice_2d.dtype)
+                    # Reserved until cleanup, for however many images the pipeline holds
+                    with self._scratch_lock:
+                        directory = scratch_dir_for(nbytes, params.get('scratch_dir'), task['img_tmp_path'],
+                                                    memory=params.get('memory'), reserved=self._scratch_reserved)
+                        if directory != task['img_tmp_path']:
+                            self._scratch_reserved += nbytes
+                            task['scratch_bytes'] = nbytes
+                    if directory == task['img_tmp_path'] and params.get('scratch_dir'):
+                        print(f"Shared stacks of {image_name} ({nbytes / 1024 ** 3:.2f} GB) do not fit "
+                              f"in memory, using the tmp folder")
+                    task['stack'] = MemmapSliceStack(directory, f"img_{task['i']}", num_slices,
+                                                     slice_2d.shape, slice_2d.dtype)
+                task['stack'].planes[slice_dict['index']] = slice_2d
+            else:
+                # Save the 2D slice
+                slice_dict['path'] = os.path.join(task['img_ms_prep_path'], slice_dict['filename'])
+                tifffile.imwrite(slice_dict['path'], slice_2d)
+        
+        if self.embedding_cache is not None:
+            with self.profile.stage('cache_key', image_name):
+                slice_dict['cache_key'] = EmbeddingCache.key(
+                    slice_2d, params['model_type'], task['segment_options']['tile_shape'],
+                    task['segment_options']['halo'], params['scale_factor'], params.get('precision', 'fp32'))
+
+    @_image_stage
+    def segment(self, task):
+        """Process all slices of an image on the persistent workers, one item per unit"""
+        if task['error'] is not None:
+            return task
+        try:
+            return self._submit(task)
+        except Exception as e:
+            # The write stage reports the error and cleans up, the next image goes on
+            return self._fail(task, e)
+
+    def _submit(self, task):
+        """Queue the units of an image that still need labels on the worker pool"""
+        units = [(unit_id, planes) for unit_id, planes in task['units'].items()
+                 if not planes[0]['blank'] and planes[0]['checkpoint'] is None]
+        if len(units) == 0:
+            return task
+        mode = self.params['dimension_mode']
+        self.update(task['progress'] + 10, f"Processing {sum(len(p) for _, p in units)} slices with micro-sam")
+        
+        cache = self.embedding_cache
+        items = []
+        cache_misses = []
+        for unit_id, planes in units:
+            cache_key = None
+            if cache is not None:
+                cache_key = planes[0]['cache_key']
+                if mode != '2d':
+                    # A volume's embeddings depend on all of its planes
+                    cache_key = hashlib.sha256("|".join([mode] + [s['cache_key'] for s in planes]).encode('utf-8')).hexdigest()
+                embedding_path, hit = cache.lookup(cache_key)
+                if not hit:
+                    cache_misses.append((cache_key, unit_id, embedding_path))
+            else:
+                embedding_path = os.path.join(task['img_ms_emb_path'], os.path.splitext(unit_id)[0] + "_embeddings.zarr")
+            item = {
+                'id': unit_id,
+                'embedding_path': embedding_path
+            }
+            if mode != '2d':
+                item['ndim'] = 3
+                item['tracking'] = mode == 'tracking'
+                if task['stack'] is not None:
+                    item['indices'] = [s['index'] for s in planes]
+                else:
+                    item['paths'] = [s['path'] for s in planes]
+            elif task['stack'] is not None:
+                item['index'] = planes[0]['index']
+            else:
+                item['path'] = planes[0]['path']
+            items.append(item)
+        
+        # Queue all units on the worker pool; the write stage collects the labels
+        task['cache_misses'] = cache_misses
+        # Without a shared stack the labels come over the pipe; they wait on disk for the writer
+        task['pending'] = self.pool.submit(items, task['segment_options'], stack=task['stack'],
+                                           spill_dir=task['img_tmp_path'] if task['stack'] is None else None)
+        return task
+
+    def _plane_shape(self, task):
+        """YX shape of the label planes written for an image, always the input resolution"""
+        return (task['dims']['Y'], task['dims']['X'])
+
+    def _labels(self, task):
+        """
+        Yield one uint16 label plane per slice in TZCYX page order, waiting
+        for each slice as needed. Raises MicroSamWorkerError if a unit was
+        not segmented, so no empty planes stand in for missing results.
+        """
+        plane_shape = self._plane_shape(task)
+        pending = task.get('pending')
+        # Labels of volumes/tracks that still have planes to be written
+        held, remaining = {}, {unit_id: len(planes) for unit_id, planes in task['units'].items()}
+        for slice_dict in task['slice_info']:
+            plane = np.zeros(plane_shape, dtype=np.uint16)
+            if slice_dict['blank']:
+                yield plane
+                continue
+            unit_id = slice_dict['unit']
+            if unit_id not in held:
+                held[unit_id] = self._unit_labels(task, unit_id, pending)
+            slice_result = held[unit_id]
+            remaining[unit_id] -= 1
+            if remaining[unit_id] == 0:
+                del held[unit_id]
+            if slice_result is not None and slice_dict['unit_pos'] is not None:
+                slice_result = slice_result[slice_dict['unit_pos']]
+            if slice_result is not None and np.any(slice_result > 0):
+                with self.profile.stage('assemble_labels', task['bfimg'].filename):
+                    if slice_result.shape != plane_shape:
+                        # Segmented at another scale, bring the labels back to the input grid
+                        slice_result = upsample_labels(slice_result, plane_shape,
+                                                       smooth=self.params.get('smooth_boundaries', False))
+                    plane[:] = slice_result
+            yield plane
+
+    def _unit_labels(self, task, unit_id, pending):
+        """Labels of one unit, from the checkpoint or the worker; new results are checkpointed"""
+        planes = task['units'][unit_id]
+        if planes[0]['checkpoint'] is not None:
+            with self.profile.stage('load_checkpoint', task['bfimg'].filename):
+                return np.load(planes[0]['checkpoint'])
+        with self.profile.stage('wait_labels', task['bfimg'].filename):
+            labels = pending.take(unit_id) if pending is not None else None
+        if labels is None:
+            task['failed_ids'].add(unit_id)
+            errors = "; ".join(pending.errors) if pending is not None else ""
+            raise MicroSamWorkerError(f"No result returned for {unit_id}" + (f": {errors}" if errors else ""))
+        if self.manifest is not None:
+            with self.profile.stage('save_checkpoint', task['bfimg'].filename):
+                plan = task['plan']
+                self.manifest.record(task['image_key'], unit_id, [(s['t'], s['z'], s['c']) for s in planes], labels,
+                                     plan['tile_shape'], plan['halo'])
+        return labels
+
+    def _finish_segmentation(self, task):
+        """Report worker failures and publish the new embeddings of an image"""
+        pending = task.get('pending')
+        task['pending'] = None
+        if pending is None:
+            return
+        try:
+            pending.result()
+        except MicroSamWorkerError as e:
+            # Log the error; an image with failed units has no label image
+            error_message = f"Micro-SAM failed: {e}"
+            print(f"ERROR: {error_message}")
+            self.update(task['progress'] + 25, f"Warning: {error_message[:500]}")
+        for unit_id, timing in pending.timings.items():
+            self.profile.add('inference', task['bfimg'].filename, unit_id, wall=timing['seconds'],
+                             cpu=timing.get('cpu_seconds'), rss=timing.get('peak_rss_mb'))
+        self._count(segmented_planes=sum(len(task['units'][unit_id]) for unit_id in pending.timings),
+                    segment_seconds=sum(timing['seconds'] for timing in pending.timings.values()))
+        cache, cache_misses = self.embedding_cache, task.get('cache_misses', [])
+        if cache is None:
+            return
+        for cache_key, unit_id, embedding_path in cache_misses:
+            # Units without timings failed or were never reached by the worker
+            if unit_id in task.get('failed_ids', ()) or unit_id not in pending.timings:
+                cache.discard(embedding_path)
+            else:
+                cache.commit(cache_key, embedding_path)
+        num_units = sum(1 for planes in task['units'].values()
+                        if not planes[0]['blank'] and planes[0]['checkpoint'] is None)
+        print(f"Embedding cache: {num_units - len(cache_misses)} hits, {len(cache_misses)} misses")
+
+    @_image_stage
+    def write(self, task):
+        """Stream the labels into a TZCYX OME-TIFF in the output folder as they arrive"""
+        final_dest_path = None
+        try:
+            if task['error'] is not None:
+                # Continue with next image instead of terminating
+                self.update(task['progress'], f"Warning: {task['error'][:500]}")
+                return task
+            
+            bfimg, params = task['bfimg'], self.params
+            time_points, z_indices, channels = task['time_points'], task['z_indices'], task['channels']
+            scale_factor = params['scale_factor']
+            task['failed_ids'] = set()
+            
+            # Only the selected time points, z-slices and channels are written; the
+            # slices are generated in TZC order, so they map 1:1 onto the OME-TIFF pages
+            label_ids = set()
+            def pages():
+                for slice_dict, plane in zip(task['slice_info'], self._labels(task)):
+                    # Keep a running object count instead of rescanning the whole result
+                    plane_ids = np.unique(plane)
+                    label_ids.update(plane_ids.tolist())
+                    if self.exporter is not None and len(plane_ids) > 1:
+                        self.exporter.add_plane(bfimg, slice_dict['t'], slice_dict['z'], slice_dict['c'], plane)
+                    yield plane
+            
+            # Save the 5D result plane by plane, straight into the output directory
+            # CRITICAL: Use ome=True to ensure proper OME-TIFF metadata is written
+            # This prevents dimension flattening and ensures correct SizeT/SizeZ values
+            final_dest_path = os.path.join(self.out_path, bfimg.filename)
+            shape = (len(time_points), len(z_indices), len(channels)) + self._plane_shape(task)
+            # A streamed write cannot switch to BigTIFF by itself like imwrite does for large data
+            nbytes = int(np.prod(shape)) * np.dtype(np.uint16).itemsize
+            with tifffile.TiffWriter(final_dest_path, ome=True, bigtiff=nbytes > 2 ** 32 - 2 ** 25) as tif:
+                tif.write(pages(),
+                          shape=shape,
+                          dtype=np.uint16,
+                          metadata={
+                              'axes': 'TZCYX',
+                              # Add explicit mapping to show which original indices were processed
+                              'dimension_mapping': {
+                                  'T': time_points,
+                                  'Z': z_indices,
+                                  'C': channels
+                              },
+                              'microsam_params': {
+                                  'model_type': params['model_type'],
+                                  'segmentation_mode': params['segmentation_mode'],
+                                  'scale_factor': scale_factor,
+                                  'precision': params.get('precision', 'fp32')
+                              }
+                          },
+                          photometric='minisblack',
+                          description='Processed with Micro-SAM, standardized to TZCYX format')
+            self._finish_segmentation(task)
+            if self.exporter is not None:
+                self.exporter.finish_image(bfimg)
+            
+            # Log objects counted
+            num_objects = len(label_ids - {0})  # Background (0) is not an object
+            self.update(task['progress'] + int(60 / self.total_images),
+                        f"Completed {bfimg.filename}: Found {num_objects} objects")
+        except Exception as e:
+            self._fail(task, e)
+            self.update(task['progress'], f"Warning: {task['error'][:500]}")
+            # Do not leave a truncated label image behind for the upload
+            if final_dest_path is not None and os.path.exists(final_dest_path):
+                os.remove(final_dest_path)
+            if self.exporter is not None and final_dest_path is not None:
+                self.exporter.discard_image(task['bfimg'])
+            # Still keep the embeddings and timings of the units that did succeed
+            self._finish_segmentation(task)
+        finally:
+            self.cleanup(task)
+        return task
+
+    def skip_summary(self):
+        """Log line on the blank planes that were not segmented and the time that saved"""
+        stats = self.stats
+        if stats['skipped_planes'] == 0:
+            return None
+        seconds_per_plane = stats['segment_seconds'] / stats['segmented_planes'] if stats['segmented_planes'] else 0.0
+        return (f"Skipped {stats['skipped_planes']}/{stats['planes']} blank planes, "
+                f"saving ~{stats['skipped_planes'] * seconds_per_plane:.1f}s of segmentation "
+                f"({seconds_per_plane:.2f}s per plane)")
+
+    def save_cprofile(self, directory):
+        """Dump the merged cProfile stats of the 'profile_image' and log the top entries"""
+        if not self.cprofiles:
+            return None
+        stats = pstats.Stats(self.cprofiles[0])
+        for profiler in self.cprofiles[1:]:
+            stats.add(profiler)
+        path = os.path.join(directory, f"microsam_profile_{os.path.splitext(self.params['profile_image'])[0]}.prof")
+        stats.dump_stats(path)
+        report = io.StringIO()
+        stats.stream = report
+        stats.sort_stats('cumulative').print_stats(25)
+        print(report.getvalue())
+        return path
+
+    def cleanup(self, task):
+        """Clean up temporary files for this image to prevent accumulation"""
+        if task.get('pending') is not None:
+            # Never pull the shared stack away from a worker that still uses it
+            task['pending'].wait()
+            task['pending'] = None
+        if task['image'] is not None:
+            task['image'].close()
+            task['image'] = None
+        if task['stack'] is not None:
+            task['stack'].close()
+            task['stack'] = None
+        if task.get('scratch_bytes'):
+            with self._scratch_lock:
+                self._scratch_reserved -= task.pop('scratch_bytes')
+        shutil.rmtree(task['img_tmp_path'], ignore_errors=True)
+
+def run_pipeline(processor, images, depth=1):
+    """
+    Run prepare -> segment -> write over (index, image) pairs as a pipeline.
+
+    Preparing runs in a producer thread and writing in a consumer thread,
+    connected to the segmentation stage by queues holding at most `depth`
+    images. Loading the next image and writing the previous result thus
+    overlap with inference on the current one, while memory stays bounded
+    to 2 * depth + 3 images: one being prepared, `depth` in each queue, one
+    waiting to be queued after submitting it for segmentation and one being
+    written. depth <= 0 runs the stages one after another.
+    """
+    if depth <= 0:
+        for i, bfimg in images:
+            processor.write(processor.segment(processor.prepare(i, bfimg)))
+        return
+
+    prepared = queue.Queue(maxsize=depth)
+    segmented = queue.Queue(maxsize=depth)
+    done = object()
+    errors = []
+    # Set when the segmentation stage fails, so no further images are prepared
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for i, bfimg in images:
+                if stop.is_set():
+                    break
+                prepared.put(processor.prepare(i, bfimg))
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            prepared.put(done)
+
+    def consume():
+        while True:
+            task = segmented.get()
+            if task is done:
+                return
+            try:
+                processor.write(task)
+            except BaseException as e:
+                # Keep draining so the segmentation stage never blocks
+                errors.append(e)
+
+    producer = threading.Thread(target=produce, name="microsam-prepare", daemon=True)
+    consumer = threading.Thread(target=consume, name="microsam-write", daemon=True)
+    producer.start()
+    consumer.start()
+    task = None
+    try:
+        while True:
+            task = prepared.get()
+            if task is done:
+                break
+            segmented.put(processor.segment(task))
+            task = None
+    except BaseException:
+        # Unblock the producer and release the images it already prepared,
+        # including the one that failed here
+        stop.set()
+        while task is not done:
+            if task is not None:
+                try:
+                    processor.cleanup(task)
+                except Exception:
+                    traceback.print_exc()
+            task = prepared.get()
+        raise
+    finally:
+        segmented.put(done)
+        consumer.join()
+        producer.join()
+    if errors:
+        raise errors[0]
+
 def main(argv):
-    with BiaflowsJob.from_cli(argv) as bj:
+    # A cancelled job gets SIGTERM; exit normally so the scratch folder is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    with BiaflowsJob.from_cli(argv) as bj, job_scratch_dir() as scratch_dir:
         # Set problem class, adjust if needed
         problem_cls = get_discipline(bj, default=CLASS_OBJSEG)
 
         bj.job.update(status=Job.RUNNING, progress=0, statusComment="Initialisation...")
+        # Timing and memory of every stage, written next to the outputs at the end
+        profile = RunProfile()
 
         # 1. Prepare data for workflow
         # is_2d=None allows handling both 2D and 3D if micro_sam supports it via ndim
-        in_imgs, gt_imgs, in_path, gt_path, out_path, tmp_path = prepare_data(problem_cls, bj, is_2d=None, **bj.flags)        # Make tmp_path unique if running multiple instances concurrently
+        with profile.stage('prepare_data'):
+            in_imgs, gt_imgs, in_path, gt_path, out_path, tmp_path = prepare_data(problem_cls, bj, is_2d=None, **bj.flags)        # Make tmp_path unique if running multiple instances concurrently
         unique_tmp_suffix = f"_{int(time.time() * 1000)}"
         tmp_path = os.path.join(tmp_path, f"microsam_run{unique_tmp_suffix}")
         os.makedirs(tmp_path, exist_ok=True)
 
-        # Final assembled results directory (shared across all images)
-        ms_final_path = os.path.join(tmp_path, "ms_assembled")
-        os.makedirs(ms_final_path, exist_ok=True)
         
         # 2. Run image analysis workflow (micro-sam)
         bj.job.update(progress=5, statusComment="Launching Micro-SAM segmentation...")
@@ -136,281 +2276,190 @@ def main(argv):
         
         # Optional Parameters
         ndim = getattr(bj.parameters, 'ndim', 2) # Default to 2D for micro-sam
+        tracking = bool(getattr(bj.parameters, 'tracking', False))  # Segment and track each time series
+        # ndim=3 segments each (t, c) z-stack as one volume, tracking each (z, c) time series
+        dimension_mode = 'tracking' if tracking else ('volume' if ndim is not None and int(ndim) == 3 else '2d')
         tile_shape_str = getattr(bj.parameters, 'tile_shape', None)
         halo_str = getattr(bj.parameters, 'halo', None)        # Parameters for multidimensional handling
         channel = getattr(bj.parameters, 'channel', 0)  # Default to channel 0 (set to -1 to process all channels)
-        batch_size = getattr(bj.parameters, 'batch_size', 1)
+        batch_size = getattr(bj.parameters, 'batch_size', 0)  # 0 lets the planner choose
         z_slices = getattr(bj.parameters, 'z_slices', -1)  # Default to all z-slices (-1)
         time_series = getattr(bj.parameters, 'time_series', -1)  # Default to all time points (-1)
         scale_factor = getattr(bj.parameters, 'scale_factor', 1.0)
-          # --- Process each image ---
-        total_images = len(in_imgs)
-        for i, bfimg in enumerate(in_imgs):
-            progress = 5 + int(60 * (i / total_images))
-            bj.job.update(progress=progress, statusComment=f"Processing image {i+1}/{total_images}: {bfimg.filename}")
-            
-            # Input/output file paths
-            in_file_path = os.path.join(in_path, bfimg.filename)
-            
-            # Create unique temporary directories for this specific image
-            img_tmp_path = os.path.join(tmp_path, f"img_{i}")
-            img_ms_prep_path = os.path.join(img_tmp_path, "ms_prep")
-            img_ms_out_path = os.path.join(img_tmp_path, "ms_output")
-            img_ms_emb_path = os.path.join(img_tmp_path, "ms_embeddings")
-            
-            # Create directories for this image
-            for path in [img_tmp_path, img_ms_prep_path, img_ms_out_path, img_ms_emb_path]:
-                os.makedirs(path, exist_ok=True)
-            
-            try:
-                # Load the input image
-                img = tifffile.imread(in_file_path)
-                axes = None
-                with tifffile.TiffFile(in_file_path) as tif:
-                    if hasattr(tif.series[0], 'axes'):
-                        axes = tif.series[0].axes
-                        
-                # Convert to standardized 5D format (TZCYX)
-                bj.job.update(progress=progress, statusComment=f"Processing image with original axes: {axes}")
-                axes = axes if axes else guess_axes(img.shape)
-                img_5d, axes_5d = convert_to_5d_from_tifffile(img, axes, target="TZCYX")
-                
-                # Get image dimensions
-                dims = {
-                    'T': img_5d.shape[0],  # Time
-                    'Z': img_5d.shape[1],  # Depth/slices
-                    'C': img_5d.shape[2],  # Channels
-                    'Y': img_5d.shape[3],  # Height
-                    'X': img_5d.shape[4]   # Width
-                }
-                bj.job.update(progress=progress, statusComment=f"Dimensions (TZCYX): {dims}")                # Determine which slices to process based on parameters
-                # Time points
-                if time_series == -1:
-                    time_points = list(range(dims['T']))
-                else:
-                    time_points = [time_series] if time_series < dims['T'] else [0]
-                    
-                # Z-slices
-                if z_slices == -1:
-                    z_indices = list(range(dims['Z']))
-                else:
-                    z_indices = [z_slices] if z_slices < dims['Z'] else [0]
-                    
-                # Channels - handle similar to Cellpose
-                if channel == -1:
-                    # Process all channels
-                    channels = list(range(dims['C']))
-                elif isinstance(channel, (list, tuple)):
-                    channels = list(channel)
-                else:
-                    # Single channel specified (default is 0)
-                    channels = [channel] if channel < dims['C'] else [0]
-                    
-                # Handle case of no channels (shouldn't happen but defensive programming)
-                if len(channels) == 0:
-                    img_5d = np.expand_dims(img_5d, axis=2)
-                    dims['C'] = 1
-                    channels = [0]
-                  # Log which dimensions are being processed
-                total_slices_to_process = len(time_points) * len(z_indices) * len(channels)
-                bj.job.update(progress=progress, 
-                            statusComment=f"Processing {len(time_points)} time points, {len(z_indices)} z-slices, {len(channels)} channels ({total_slices_to_process} total slices)")
-                print(f"Time points: {time_points}")
-                print(f"Z-slices: {z_indices}")
-                print(f"Channels: {channels}")
-                if len(channels) == 1 and dims['C'] > 1:
-                    print(f"Note: Only processing channel {channels[0]} out of {dims['C']} available channels. Set channel=-1 to process all channels.")
-                
-                # Create a 5D output array matching ONLY the selected dimensions
-                # This is a key change - only make space for channels we're actually processing
-                output_shape = (
-                    len(time_points),
-                    len(z_indices),
-                    len(channels),
-                    int(dims['Y'] * scale_factor) if scale_factor != 1.0 else dims['Y'],
-                    int(dims['X'] * scale_factor) if scale_factor != 1.0 else dims['X']
-                )
-                
-                # Use uint16 for label mask output
-                output_5d = np.zeros(output_shape, dtype=np.uint16)
-                
-                # Create mapping from original indices to output array indices
-                index_mapping = {
-                    'T': {t: idx for idx, t in enumerate(time_points)},
-                    'Z': {z: idx for idx, z in enumerate(z_indices)},
-                    'C': {c: idx for idx, c in enumerate(channels)}
-                }
-                
-                # Group slices by channel for batch processing
-                slice_info = []
-                
-                # First, create all the 2D slices needed and track their info
-                for t, z, c in itertools.product(time_points, z_indices, channels):
-                    # Extract 2D slice
-                    slice_2d = img_5d[t, z, c, :, :]
-                    
-                    # Apply scaling if needed
-                    if scale_factor != 1.0:
-                        slice_2d = rescale(slice_2d, scale_factor, order=1, 
-                                         preserve_range=True, channel_axis=None, 
-                                         anti_aliasing=True).astype(slice_2d.dtype)                    # Create a simple unique filename for this slice
-                    slice_fname = f"slice_t{t}_z{z}_c{c}.tif"
-                    slice_path = os.path.join(img_ms_prep_path, slice_fname)
-                    
-                    # Save the 2D slice
-                    tifffile.imwrite(slice_path, slice_2d)
-                    
-                    # Store slice information for later processing
-                    slice_info.append({
-                        'filename': slice_fname,
-                        't': t,
-                        'z': z,
-                        'c': c,
-                        'path': slice_path
-                    })                # Track number of slices created
-                print(f"Created {len(slice_info)} slices for processing")
-                  # Debug: Print all created filenames
-                print("Created slice filenames:")
-                for info in slice_info:
-                    print(f"  - {info['filename']}")
-                
-                # Process all slices in a single batch (no need for channel grouping)
-                if len(slice_info) > 0:
-                    bj.job.update(progress=progress + 10, 
-                                statusComment=f"Processing {len(slice_info)} slices with micro-sam")
-                    
-                    # Use simple wildcard pattern to process all slice files at once
-                    pattern = "*"
-                      # Debug: Print pattern and matching files
-                    print(f"Using pattern: {pattern}")
-                    print(f"Files in prep directory: {os.listdir(img_ms_prep_path)}")
-                    
-                    # Build micro-sam command for batch processing
-                    cmd = [
-                        "conda", "run", "-n", MICROSAM_ENV_NAME,
-                        "micro_sam.automatic_segmentation",
-                        "--input_path", img_ms_prep_path,
-                        "--output_path", img_ms_out_path,
-                        "--embedding_path", img_ms_emb_path,
-                        "--pattern", pattern,
-                        "--model_type", model_type,
-                        "--mode", segmentation_mode
-                    ]
-                    
-                    # Add optional arguments
-                    if ndim is not None:
-                        cmd.extend(["--ndim", str(ndim)])
-                    if tile_shape_str:
-                        cmd.extend(["--tile_shape", tile_shape_str])
-                    if halo_str:
-                        cmd.extend(["--halo", halo_str])
-                    if batch_size > 1:
-                        cmd.extend(["--batch_size", str(batch_size)])
-                    
-                    # Add verbose flag
-                    cmd.extend(["--verbose"])
-                    
-                    print(f"Running command: {' '.join(cmd)}")
-                    
-                    # Execute micro-sam for all slices
-                    try:
-                        result = subprocess.run(cmd, check=True, text=True, capture_output=True)
-                        print("Command output:", result.stdout)
-                          # Process each slice result
-                        for slice_dict in slice_info:
-                            slice_out_path = os.path.join(img_ms_out_path, slice_dict['filename'])
-                            t, z, c = slice_dict['t'], slice_dict['z'], slice_dict['c']
-                            
-                            # Check primary location (multiple files case)
-                            if os.path.exists(slice_out_path):
-                                slice_result = tifffile.imread(slice_out_path)
-                            # Check fallback location (single file case - micro-sam outputs to directory.tif)
-                            elif len(slice_info) == 1 and os.path.exists(img_ms_out_path + '.tif'):
-                                slice_result = tifffile.imread(img_ms_out_path + '.tif')
-                            else:
-                                print(f"Warning: No output file found at {slice_out_path}")
-                                if len(slice_info) == 1:
-                                    print(f"Also checked fallback location: {img_ms_out_path + '.tif'}")
-                                continue
-                            
-                            # Handle case where output is relabeled (starts from 1)
-                            if np.any(slice_result > 0):
-                                # Get indices in the reduced output array using our mapping
-                                t_idx = index_mapping['T'][t]
-                                z_idx = index_mapping['Z'][z]
-                                c_idx = index_mapping['C'][c]
-                                
-                                # Copy slice result to output array with correct indexing
-                                output_5d[t_idx, z_idx, c_idx, :slice_result.shape[0], :slice_result.shape[1]] = slice_result
-                            
-                    except subprocess.CalledProcessError as e:
-                        # Log the error but continue processing other images
-                        error_message = f"Micro-SAM failed with code {e.returncode}"
-                        print(f"ERROR: {error_message}")
-                        print(f"Stderr: {e.stderr}")
-                        print(f"Stdout: {e.stdout}")
-                        bj.job.update(progress=progress + 25, statusComment=f"Warning: {error_message}")
-                        # Continue with next image                # Save the assembled 5D result
-                # CRITICAL: Use ome=True to ensure proper OME-TIFF metadata is written
-                # This prevents dimension flattening and ensures correct SizeT/SizeZ values
-                final_out_path = os.path.join(ms_final_path, bfimg.filename)
-                imwrite(final_out_path, output_5d, 
-                       metadata={
-                           'axes': 'TZCYX',
-                           # Add explicit mapping to show which original indices were processed
-                           'dimension_mapping': {
-                               'T': time_points,
-                               'Z': z_indices,
-                               'C': channels
-                           },
-                           'microsam_params': {
-                               'model_type': model_type,
-                               'segmentation_mode': segmentation_mode,
-                               'scale_factor': scale_factor
-                           }
-                       },
-                       photometric='minisblack',
-                       ome=True,  # Essential for proper 5D dimension preservation
-                       description='Processed with Micro-SAM, standardized to TZCYX format')
-                
-                # Copy the final result to the output directory
-                final_dest_path = os.path.join(out_path, bfimg.filename)
-                shutil.copyfile(final_out_path, final_dest_path)
-                  # Log objects counted
-                num_objects = len(np.unique(output_5d)) - 1  # Subtract 1 for background (0)
-                bj.job.update(progress=progress + int(60 * (i+1) / total_images),
-                            statusComment=f"Completed {bfimg.filename}: Found {num_objects} objects")
-                
-                # Clean up temporary files for this image to prevent accumulation
-                shutil.rmtree(img_tmp_path, ignore_errors=True)
-                
-            except Exception as e:
-                error_message = f"Error processing {bfimg.filename}: {str(e)}"
-                print(error_message)
-                import traceback
-                traceback.print_exc()
-                # Clean up temporary files even on error
-                shutil.rmtree(img_tmp_path, ignore_errors=True)
-                # Continue with next image instead of terminating
-                bj.job.update(progress=progress, statusComment=f"Warning: {error_message[:500]}")
-                continue
+        transport = getattr(bj.parameters, 'transport', 'memmap') or 'memmap'  # 'memmap' or 'file'
+        precision = getattr(bj.parameters, 'precision', 'fp32') or 'fp32'  # image encoder: 'fp32', 'bf16' or 'int8'
+        if precision not in ('fp32', 'bf16', 'int8'):
+            print(f"Unknown precision '{precision}', falling back to 'fp32'")
+            precision = 'fp32'
+        if precision == 'int8':
+            print("Warning: precision 'int8' is experimental, its accuracy against fp32 has not been validated")
+        if transport not in ('memmap', 'file'):
+            print(f"Unknown transport '{transport}', falling back to 'memmap'")
+            transport = 'memmap'
+
+        # Optional embedding cache that survives across jobs
+        embedding_cache_path = getattr(bj.parameters, 'embedding_cache', None)
+        embedding_cache_size = float(getattr(bj.parameters, 'embedding_cache_size', 20) or 20)  # GB
+        embedding_cache = None
+        if embedding_cache_path:
+            embedding_cache = EmbeddingCache(embedding_cache_path, int(embedding_cache_size * 1024 ** 3))
+            print(f"Using embedding cache at {embedding_cache_path} (limit {embedding_cache_size} GB)")
+
+        # Options shared by every segmentation request sent to the worker
+        segment_options = {
+            # Planes are sent one by one unless grouped into volumes, see dimension_mode
+            'ndim': 2,
+            'tile_shape': parse_shape(tile_shape_str),
+            'halo': parse_shape(halo_str),
+            'batch_size': int(batch_size or 0),
+            'verbose': True
+        }
+
+        # Tiling, halo and batch size are planned per image unless given explicitly
+        auto_plan = bool(getattr(bj.parameters, 'auto_plan', True))
+        plan_overrides = {}
+        if segment_options['tile_shape'] is not None or str(tile_shape_str or '').strip().lower() == 'none':
+            # 'none' forces untiled prediction
+            plan_overrides['tile_shape'] = segment_options['tile_shape']
+        if segment_options['halo'] is not None:
+            plan_overrides['halo'] = segment_options['halo']
+        if segment_options['batch_size'] > 0:
+            plan_overrides['batch_size'] = segment_options['batch_size']
+        memory_limit = float(getattr(bj.parameters, 'memory_limit', 0) or 0)  # GB, 0 = detect
+
+        # Optional checkpoint of finished units; a rerun with the same parameters resumes from it
+        checkpoint_dir = getattr(bj.parameters, 'checkpoint_dir', None)
+        manifest = None
+        if checkpoint_dir:
+            manifest = JobManifest(checkpoint_dir, {
+                'model_type': model_type,
+                'segmentation_mode': segmentation_mode,
+                'dimension_mode': dimension_mode,
+                'tile_shape': segment_options['tile_shape'],
+                'halo': segment_options['halo'],
+                'scale_factor': float(scale_factor),
+                **({'precision': precision} if precision != 'fp32' else {})
+            })
+            print(f"Checkpointing to {checkpoint_dir} ({len(manifest.units)} units done by earlier runs)")
+
+        # Start micro-sam once; the model stays loaded for all images of the job
+        num_workers = int(getattr(bj.parameters, 'num_workers', 1) or 1)
+        if auto_plan:
+            # More workers than cores, or model copies than memory, only slow the job down
+            planned = plan_workers(num_workers, model_type, cores=available_cores(),
+                                   memory=int(memory_limit * 1024 ** 3) if memory_limit > 0 else available_memory())
+            if planned < num_workers:
+                print(f"Starting {planned} instead of {num_workers} micro-sam workers for the "
+                      f"{available_cores()} cores and the memory available")
+                num_workers = planned
+        bj.job.update(progress=5, statusComment="Loading Micro-SAM model...")
+        worker = MicroSamWorkerPool(model_type, segmentation_mode, num_workers=num_workers, profile=profile,
+                                    precision=precision)
+        worker.start()
+        # Measured with the models loaded, so the plan only has to fit the inference itself
+        memory = int(memory_limit * 1024 ** 3) if memory_limit > 0 else available_memory()
+        if auto_plan:
+            print(f"Planning with {memory / 1024 ** 3:.1f} GB of memory" if memory else
+                  "Available memory unknown, planning with 4 GB")
+
+        # Annotations are extracted from the label planes while they are written and
+        # uploaded in batches during the segmentation of the next images, instead of
+        # re-reading the label images in upload_data afterwards
+        annotation_export = str(getattr(bj.parameters, 'annotation_export', 'builtin') or 'builtin').lower()
+        if annotation_export not in ('builtin', 'biaflows'):
+            raise ValueError(f"Unknown annotation_export '{annotation_export}', use 'builtin' or 'biaflows'")
+        exporter = None
+        if (annotation_export == 'builtin' and problem_cls == CLASS_OBJSEG
+                and bj.flags.get('do_upload_annotations', True) and not bj.flags.get('is_local', False)
+                and all(getattr(img, 'object', None) is not None for img in in_imgs)):
+            exporter = AnnotationExporter(
+                project_id=getattr(getattr(bj, 'project', None), 'id', None),
+                batch_size=int(getattr(bj.parameters, 'upload_batch_size', 1000) or 1000),
+                max_queued_bytes=int((memory or 4 * 1024 ** 3) * EXPORT_MEMORY_SHARE), profile=profile).start()
+
+        # --- Process each image ---
+        # Loading/slicing, inference and writing run as a pipeline over the images
+        pipeline_depth = int(getattr(bj.parameters, 'pipeline_depth', 1))
+        processor = ImageProcessor(bj, worker, in_path, out_path, tmp_path, len(in_imgs), {
+            'model_type': model_type,
+            'segmentation_mode': segmentation_mode,
+            'channel': channel,
+            'z_slices': z_slices,
+            'time_series': time_series,
+            'scale_factor': scale_factor,
+            'transport': transport,
+            'precision': worker.workers[0].precision,
+            'dimension_mode': dimension_mode,
+            'blank_threshold': float(getattr(bj.parameters, 'blank_threshold', 0) or 0),
+            'smooth_boundaries': bool(getattr(bj.parameters, 'smooth_boundaries', False)),
+            'profile_image': getattr(bj.parameters, 'profile_image', None) or None,
+            'plane_batch': 16,
+            'auto_plan': auto_plan,
+            'plan_overrides': plan_overrides,
+            'memory': memory,
+            'scratch_dir': scratch_dir if transport == 'memmap' else None,
+            'pipeline_depth': pipeline_depth,
+            'segment_options': segment_options
+        }, embedding_cache=embedding_cache, profile=profile, manifest=manifest, exporter=exporter)
+        profile.info.update(images=len(in_imgs), model_type=model_type, segmentation_mode=segmentation_mode,
+                            precision=processor.params['precision'],
+                            dimension_mode=dimension_mode, transport=transport, num_workers=num_workers,
+                            pipeline_depth=pipeline_depth, scale_factor=scale_factor, cores=available_cores())
+        try:
+            with profile.stage('pipeline'):
+                run_pipeline(processor, list(enumerate(in_imgs)), depth=pipeline_depth)
+            if worker.failed is not None:
+                # Without a worker the remaining masks would all be empty
+                raise worker.failed
+        except BaseException:
+            if exporter is not None:
+                # The job fails with the pipeline error, nothing more is uploaded
+                exporter.cancel()
+            worker.close()
+            raise
+        summary = processor.skip_summary()
+        if summary:
+            print(summary)
+            bj.job.update(progress=65, statusComment=summary)
+        if manifest is not None:
+            manifest.close()
+            if processor.stats['resumed_planes']:
+                bj.job.update(progress=65, statusComment=f"Resumed {processor.stats['resumed_planes']}/"
+                                                         f"{processor.stats['planes']} planes from the checkpoint")
+
+        worker.close()
+        if embedding_cache is not None:
+            print(f"Embedding cache totals: {embedding_cache.hits} hits, {embedding_cache.misses} misses")
 
         # 3. Upload data to BIAFLOWS
         bj.job.update(progress=70, statusComment="Uploading segmentation results...")
-        upload_data(problem_cls, bj, in_imgs, out_path, **bj.flags, monitor_params={
-            "start": 70, "end": 90, "period": 0.1,
-            "prefix": "Extracting and uploading polygons from masks"})
+        if exporter is not None:
+            with profile.stage('upload_data'):
+                uploaded = exporter.close()
+            bj.job.update(progress=90, statusComment=f"Uploaded {uploaded} annotations")
+        else:
+            with profile.stage('upload_data'):
+                upload_data(problem_cls, bj, in_imgs, out_path, **bj.flags, monitor_params={
+                    "start": 70, "end": 90, "period": 0.1,
+                    "prefix": "Extracting and uploading polygons from masks"})
 
         # 4. Compute and upload metrics
         bj.job.update(progress=90, statusComment="Computing and uploading metrics...")
         # Make sure gt_path is valid if metrics are needed
         if gt_imgs:
-             upload_metrics(problem_cls, bj, in_imgs, gt_path, out_path, tmp_path, **bj.flags)
+             with profile.stage('upload_metrics'):
+                 upload_metrics(problem_cls, bj, in_imgs, gt_path, out_path, tmp_path, **bj.flags)
         else:
              print("No ground truth images found, skipping metrics calculation.")
              bj.job.update(progress=95, statusComment="Skipped metrics calculation (no GT).")
 
         # 5. Pipeline finished
+        if getattr(bj.parameters, 'profile', True) is not False:
+            for stage, total in profile.summary().items():
+                print(f"Profile {stage}: {total['wall_seconds']:.2f}s wall, {total['calls']} calls")
+            json_path, csv_path = profile.save(out_path)
+            print(f"Run profile written to {json_path} and {csv_path}")
+            processor.save_cprofile(out_path)
         # Clean up temporary directory
         shutil.rmtree(tmp_path, ignore_errors=True)
         bj.job.update(progress=100, status=Job.TERMINATED, status_comment="Finished.")